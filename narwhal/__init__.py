@@ -1,11 +1,16 @@
 
 from .cast import AbstractCast, AbstractCastCollection
 from .cast import Cast, CTDCast, XBTCast, LADCP
-from .cast import CastCollection, read
+from .cast import CastCollection, read, read_many, iterread, eofs_incremental
+from .cast import read_netcdf, read_woce_netcdf, read_woce_many
+from .lazy import LazyCastCollection
+from .cache import DerivationCache
 from .bathymetry import Bathymetry
 from . import gsw
 from . import util
+from . import geodesy
+from . import storage
 from . import plotting
 
-__all__ = ["cast", "bathymetry", "gsw", "util"]
+__all__ = ["cast", "bathymetry", "gsw", "util", "geodesy", "storage"]
 
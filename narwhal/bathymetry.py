@@ -2,9 +2,13 @@
 Bathymetry class that can be referenced to a CastCollection and automatically
 plotted.
 """
+import collections
+import hashlib
 import numpy as np
+from scipy.spatial import cKDTree
 import karta
-from karta import Point, Line
+from karta import Line
+from . import geodesy
 
 try:
     from karta.crs import crsreg
@@ -13,6 +17,152 @@ except ImportError:
 LONLAT = crsreg.LONLAT
 CARTESIAN = crsreg.CARTESIAN
 
+class SegmentIndex(object):
+    """ Spatial index over the segments of a line of (lon, lat) vertices.
+
+    Segments are treated as great circle arcs and indexed by the centres of
+    their bounding caps in a k-d tree of unit vectors. A query point is
+    projected only onto the segments that may be nearer than the nearest
+    vertex, found from a second k-d tree.
+    """
+
+    def __init__(self, lons, lats):
+        self.vertices = geodesy.unitvector(lons, lats)
+        if len(self.vertices) < 2:
+            raise ValueError("a line requires at least two vertices")
+        a, b = self.vertices[:-1], self.vertices[1:]
+        mid = a + b
+        norm = np.linalg.norm(mid, axis=1)
+        mid = mid / np.where(norm == 0.0, 1.0, norm)[:, np.newaxis]
+        # angular radius of the cap centred on each segment midpoint
+        self.radius = 0.5 * geodesy._angle(a, b)
+        self.radius[norm == 0.0] = np.pi
+        self._vtree = cKDTree(self.vertices)
+        self._stree = cKDTree(mid)
+        self._mid = mid
+        return
+
+    def __len__(self):
+        return len(self.vertices) - 1
+
+    def candidates(self, p):
+        """ Return arrays (points, segments) of the indices of pairs of query
+        unit vectors `p` and segments that must be searched to find the
+        nearest segment to each point. """
+        chord, _ = self._vtree.query(p)
+        # angular distance to the nearest vertex bounds the distance to the
+        # line, so that only caps reaching within it need be searched
+        bound = 2.0 * np.arcsin(np.clip(0.5*chord, 0.0, 1.0))
+        reach = np.minimum(bound + self.radius.max(), np.pi)
+        r = 2.0 * np.sin(0.5*reach) + 1e-12
+        # query points in groups sharing a search radius, rounded up to
+        # sixteenths of an octave, as older versions of scipy accept only a
+        # scalar radius
+        level = np.ceil(16.0*np.log2(r)).astype(int)
+        points, segments = [], []
+        for lev in np.unique(level):
+            members = np.flatnonzero(level == lev)
+            found = self._stree.query_ball_point(p[members], 2.0**(lev/16.0))
+            counts = np.array([len(f) for f in found], dtype=np.int64)
+            points.append(np.repeat(members, counts))
+            segments.append(np.fromiter((i for f in found for i in f),
+                                        dtype=np.int64, count=counts.sum()))
+        points = np.concatenate(points)
+        segments = np.concatenate(segments)
+        keep = geodesy._angle(p[points], self._mid[segments]) <= \
+                bound[points] + self.radius[segments] + 1e-12
+        return points[keep], segments[keep]
+
+    def nearest(self, lons, lats, chunksize=4096):
+        """ Return the index of the nearest segment to each point, the
+        fraction along that segment of the nearest position, and the angular
+        distance in radians. Points with NaN coordinates give index -1.
+        Points are processed `chunksize::int` at a time to bound memory. """
+        p = geodesy.unitvector(np.atleast_1d(lons), np.atleast_1d(lats))
+        n = len(p)
+        index = np.full(n, -1, dtype=np.int64)
+        fraction = np.full(n, np.nan)
+        distance = np.full(n, np.nan)
+        valid = np.flatnonzero(np.all(np.isfinite(p), axis=1))
+        for i in range(0, len(valid), chunksize):
+            chunk = valid[i:i+chunksize]
+            points, segments = self.candidates(p[chunk])
+            d, t = geodesy.nearest_on_arcs(p[chunk][points],
+                                           self.vertices[segments],
+                                           self.vertices[segments+1])
+            # the first pair of each point in order of distance
+            order = np.lexsort((segments, d, points))
+            first = order[np.r_[True, points[order][1:] != points[order][:-1]]]
+            index[chunk[points[first]]] = segments[first]
+            fraction[chunk[points[first]]] = t[first]
+            distance[chunk[points[first]]] = d[first]
+        return index, fraction, distance
+
+
+def _nearest_on_geodesics(crs, px, py, x0, y0, x1, y1, tol=0.01, maxiter=50):
+    """ Find the nearest positions to points (px, py) on the geodesics from
+    (x0, y0) to (x1, y1), all arrays of equal length, using the geodetic
+    functions of the geographical `crs`.
+
+    This evaluates the bisection scheme that karta uses for
+    `nearest_on_boundary` and `shortest_distance_to` for all pairs at once,
+    including its single precision bisection variables, so that results agree
+    with karta's. Returns the longitudes and latitudes of the nearest
+    positions and the distances to them.
+    """
+    az, _, L = crs.inverse(x0, y0, x1, y1)
+    az, L = np.asarray(az, dtype=np.float64), np.asarray(L, dtype=np.float64)
+
+    def distance(x, idx):
+        if len(idx) == 0:
+            return np.empty(0, dtype=np.float64)
+        tx, ty, _ = crs.forward(x0[idx], y0[idx], az[idx], x*L[idx])
+        return np.asarray(crs.inverse(tx, ty, px[idx], py[idx])[2])
+
+    def ddx(x, idx):
+        return (distance(x+1e-8, idx) - distance(x, idx)) / 1e-8
+
+    n = len(px)
+    everything = np.arange(n)
+    nx, ny = np.array(x0, dtype=np.float64), np.array(y0, dtype=np.float64)
+    d = np.empty(n, dtype=np.float64)
+
+    # nearest positions at the endpoints
+    atstart = ddx(np.zeros(n), everything) > 0
+    atend = ~atstart & (ddx(np.ones(n), everything) < 0)
+    d[atstart] = distance(0.0, everything[atstart])
+    d[atend] = distance(1.0, everything[atend])
+    nx[atend], ny[atend] = x1[atend], y1[atend]
+
+    # bisection on the remaining pairs
+    active = np.flatnonzero(~atstart & ~atend)
+    inner = active
+    xa = np.zeros(len(active), dtype=np.float32)
+    xb = np.ones(len(active), dtype=np.float32)
+    xm = np.empty(len(active), dtype=np.float32)
+    tol = np.float32(tol)
+    i = 0
+    pos = np.arange(len(active))
+    while len(pos) != 0:
+        if i == maxiter:
+            raise RuntimeError("Maximum iterations exhausted in bisection "
+                               "method.")
+        xm[pos] = 0.5 * (xa[pos] + xb[pos])
+        right = ddx(xm[pos].astype(np.float64), active) > 0
+        dx = np.where(right, np.abs(xb[pos]-xm[pos]), np.abs(xa[pos]-xm[pos])) \
+                * L[active]
+        xb[pos[right]] = xm[pos[right]]
+        xa[pos[~right]] = xm[pos[~right]]
+        keep = dx.astype(np.float32) > tol
+        pos, active = pos[keep], active[keep]
+        i += 1
+    if len(inner) != 0:
+        xm = xm.astype(np.float64)
+        tx, ty, _ = crs.forward(x0[inner], y0[inner], az[inner], xm*L[inner])
+        nx[inner] = np.asarray(tx, dtype=np.float32)
+        ny[inner] = np.asarray(ty, dtype=np.float32)
+        d[inner] = distance(xm, inner)
+    return nx, ny, d
 
 class Bathymetry2d(Line):
     """ Bathymetric line
@@ -35,18 +185,37 @@ class Bathymetry2d(Line):
         self.depth = np.asarray(depth)
         return
 
+    @property
+    def segment_index(self):
+        """ SegmentIndex over the segments of the bathymetry line, built on
+        first use. """
+        if getattr(self, "_segment_index", None) is None:
+            vertices = np.asarray(self.vertices, dtype=np.float64)
+            self._segment_index = SegmentIndex(vertices[:,0], vertices[:,1])
+        return self._segment_index
+
     def atxy(self, x, y):
         """ Interpolate bottom depth at a point. """
-        pt = Point((x, y), crs=LONLAT)
-        segments = tuple(self.segments)
-        distances = [seg.shortest_distance_to(pt) for seg in segments]
-        ii = distances.index(min(distances))
-        a = segments[ii][0]
-        b = segments[ii][1]
-        ptonseg = segments[ii].nearest_on_boundary(pt)
-        return (b.data["depth"] - a.data["depth"]) \
-                * (a.greatcircle(ptonseg) / a.greatcircle(b)) \
-                + a.data["depth"]
+        return self.atxy_many([x], [y])[0]
+
+    def atxy_many(self, lons, lats):
+        """ Interpolate bottom depth at many points, given as arrays of
+        longitudes and latitudes.
+
+        Each point is projected onto the nearest segment of the bathymetry
+        line, treating segments as great circle arcs, and depth is
+        interpolated linearly along the segment. Candidate segments are found
+        with `segment_index`, so that the cost grows with the number of points
+        rather than with points times segments. Points with missing
+        coordinates give NaN.
+        """
+        segments, fraction, _ = self.segment_index.nearest(lons, lats)
+        depth = np.asarray(self.depth, dtype=np.float64)
+        result = np.full(len(segments), np.nan)
+        valid = segments >= 0
+        i = segments[valid]
+        result[valid] = depth[i] + fraction[valid] * (depth[i+1] - depth[i])
+        return result
 
     def projdist(self, reverse=False):
         distances = [seg[0].greatcircle(seg[1]) for seg in self.segments()]
@@ -57,9 +226,16 @@ class Bathymetry2d(Line):
             cumulative.reverse()
         return cumulative
 
-    def project_along_cruise(self, cruiseline):
+    def project_along_cruise(self, cruiseline, chunksize=65536):
         """ Project depth locations to a cruise line.
 
+        Each bathymetry vertex is projected onto the nearest segment of the
+        cruise line. Distances from every vertex to every segment are computed
+        with array operations, at most `chunksize::int` vertex-segment pairs
+        at a time, and distances along the cruise are measured from the
+        cumulative lengths of the segments. Results are cached for the most
+        recently used cruise lines.
+
         Returns:
         --------
         p       a vector of distances along the cruise
@@ -68,20 +244,58 @@ class Bathymetry2d(Line):
         if self._crs != cruiseline._crs:
             raise karta.CRSError("CRS mismatch")
 
-        P, Q = [], []
-        for pt in self:
-            npt = cruiseline.nearest_on_boundary(pt)
-            p = 0.0
-            for i, seg in enumerate(cruiseline.segments):
-                if npt == seg.nearest_on_boundary(pt):
-                    p += npt.distance(seg[0])
-                    q = seg.shortest_distance_to(pt)
-                    break
-                else:
-                    p += seg.length
-            P.append(p)
-            Q.append(q)
-        return np.asarray(P), np.asarray(Q)
+        vertices = np.asarray(self.vertices, dtype=np.float64)[:,:2]
+        cruise = np.asarray(cruiseline.vertices, dtype=np.float64)[:,:2]
+        key = (_digest(vertices), _digest(cruise))
+        cache = getattr(self, "_projections", None)
+        if cache is None:
+            cache = self._projections = collections.OrderedDict()
+        if key in cache:
+            P, Q = cache.pop(key)
+        else:
+            P, Q = _project_along(self._crs, vertices, cruise, chunksize)
+        cache[key] = (P, Q)
+        while len(cache) > 8:
+            cache.popitem(last=False)
+        return P.copy(), Q.copy()
+
+def _digest(arr):
+    """ Return a hashable key identifying the contents of an array. """
+    arr = np.ascontiguousarray(arr)
+    return (hashlib.sha1(arr.view(np.uint8)).digest(), arr.shape, arr.dtype.str)
+
+def _project_along(crs, vertices, cruise, chunksize):
+    """ Vectorized implementation of `Bathymetry2d.project_along_cruise`. """
+    m, n = len(vertices), len(cruise) - 1
+    x0, y0 = cruise[:-1,0], cruise[:-1,1]
+    x1, y1 = cruise[1:,0], cruise[1:,1]
+    lengths = np.asarray(crs.inverse(x0, y0, x1, y1)[2], dtype=np.float64)
+    cumulative = np.concatenate([[0.0], np.cumsum(lengths)])
+
+    P, Q = np.empty(m), np.empty(m)
+    rows = max(1, chunksize // max(n, 1))
+    for start in range(0, m, rows):
+        stop = min(start+rows, m)
+        k = stop - start
+        ipt = np.repeat(np.arange(start, stop), n)
+        iseg = np.tile(np.arange(n), k)
+        nx, ny, d = _nearest_on_geodesics(crs, vertices[ipt,0], vertices[ipt,1],
+                                          x0[iseg], y0[iseg], x1[iseg], y1[iseg])
+        nx, ny, d = nx.reshape(k, n), ny.reshape(k, n), d.reshape(k, n)
+
+        # the first segment on which the nearest position of the line lies
+        # (which precedes the nearest segment when it ends at that position)
+        r = np.arange(k)
+        nearest = np.argmin(d, axis=1)
+        same = (nx == nx[r, nearest][:,np.newaxis]) & \
+               (ny == ny[r, nearest][:,np.newaxis])
+        first = np.argmax(same, axis=1)
+
+        fx, fy = nx[r, first], ny[r, first]
+        along = np.asarray(crs.inverse(fx, fy, x0[first], y0[first])[2])
+        P[start:stop] = cumulative[first] + along
+        Q[start:stop] = d[r, first]
+    return P, Q
 
 Bathymetry = Bathymetry2d
 
@@ -0,0 +1,176 @@
+""" Persistent cache for derived cast quantities.
+
+Results are stored on disk in the numpy .npz format under a key computed
+from a hash of the input arrays and the parameters of the derivation, so
+that a result is reused whenever a derivation is repeated on unchanged data,
+in the same or a later process:
+
+    cache = DerivationCache("~/.cache/narwhal", maxsize=2<<30)
+    for cast in cc:
+        cast.add_density(cache=cache)
+
+Files are written under a temporary name and moved into place atomically,
+so that several processes may share a cache directory. When the total size
+of the cache exceeds `maxsize`, the least recently used results are removed.
+The size is tracked as results are written, and the directory is only
+scanned when it exceeds `maxsize`, so results written by other processes
+are accounted for at the next eviction.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+# incremented when the output of a cached derivation changes, invalidating
+# previously cached results
+CACHE_VERSION = 1
+
+_SUFFIX = ".npz"
+
+def _replace(src, dst):
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python 2: rename replaces atomically on POSIX
+        os.rename(src, dst)
+    return
+
+class DerivationCache(object):
+    """ Content-addressed on-disk cache of derived arrays.
+
+    directory::string   directory holding cached results, created if
+                        necessary
+    maxsize::int        size in bytes above which least recently used results
+                        are evicted [default 1 GiB]
+    """
+
+    def __init__(self, directory, maxsize=1<<30):
+        self.directory = os.path.expanduser(directory)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # running total of the size of cached results, or None until the
+        # directory is first scanned
+        self._size = None
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        return
+
+    def __repr__(self):
+        return "DerivationCache({0!r}, maxsize={1})".format(self.directory,
+                                                             self.maxsize)
+
+    @staticmethod
+    def key(name, inputs, params=None):
+        """ Return the hexadecimal key for derivation `name::string` applied to
+        the sequence of arrays `inputs` with the JSON-serializable dict
+        `params`. """
+        h = hashlib.sha1()
+        h.update(json.dumps([CACHE_VERSION, name, params or {}],
+                            sort_keys=True).encode("utf-8"))
+        for arr in inputs:
+            arr = np.ascontiguousarray(arr)
+            h.update(json.dumps([arr.dtype.str, arr.shape]).encode("utf-8"))
+            h.update(arr.view(np.uint8).data if arr.size != 0 else b"")
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def get(self, key):
+        """ Return the list of arrays stored under `key`, or None. """
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                arrays = [npz["arr_{0}".format(i)] for i in range(len(npz.files))]
+            # record use for eviction
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, KeyError):
+            # missing, or removed by another process
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        """ Store the sequence of arrays `arrays` under `key`. """
+        if self._size is None:
+            self._size = self.size()
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, *[np.asarray(a) for a in arrays])
+            size = os.path.getsize(tmp)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            _replace(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._size += size - replaced
+        if self._size > self.maxsize:
+            self.evict()
+        return
+
+    def cached(self, name, inputs, params, func):
+        """ Return `func()`, an array or tuple of arrays, reusing the result
+        stored for `name`, `inputs`, and `params` if there is one. """
+        key = self.key(name, inputs, params)
+        arrays = self.get(key)
+        if arrays is not None:
+            self.hits += 1
+            return arrays[0] if len(arrays) == 1 else tuple(arrays)
+        self.misses += 1
+        result = func()
+        self.put(key, [result] if isinstance(result, np.ndarray) else result)
+        return result
+
+    def _entries(self):
+        entries = []
+        for fnm in os.listdir(self.directory):
+            if fnm.endswith(_SUFFIX):
+                path = os.path.join(self.directory, fnm)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self):
+        """ Return the total size in bytes of cached results. """
+        return sum(size for (_, size, _) in self._entries())
+
+    def evict(self):
+        """ Remove least recently used results until the cache is no larger
+        than `maxsize`. """
+        entries = self._entries()
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+        return
+
+    def clear(self):
+        """ Remove all cached results. """
+        for (_, _, path) in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._size = 0
+        return
@@ -11,19 +11,32 @@ import itertools
 import json
 import gzip
 import copy
-from functools import reduce
+import glob
+import datetime
+import numbers
+import warnings
+import pickle
+import multiprocessing
+from functools import reduce, partial
 import six
 import numpy as np
 import pandas
 from scipy import ndimage
 from scipy import sparse as sprs
 from scipy.interpolate import UnivariateSpline
-from scipy.io import netcdf_file
-from karta import Point, Multipoint
+from karta import Multipoint
 from . import units
 from . import fileio
 from . import gsw
 from . import util
+from . import geodesy
+from . import storage as _storage
+from .proptable import PropertyTable
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
 try:
     from karta.crs import crsreg
@@ -234,25 +247,72 @@ class Cast(object):
         ret.data = newdata
         return ret
 
-    def save(self, fnm, binary=True):
+    def save(self, fnm, binary=True, compact=False, storage=None):
         """ Save a JSON-formatted representation to a file at `fnm::string`.
+        File names ending in ".nwb" are written in the binary columnar format
+        instead (see `fileio.writebinary`), names ending in ".nwd" in the
+        newline-delimited format, and names ending in ".nwx" in the blocked
+        gzip format (see `fileio.writeblocked`). If `compact::bool` is True, JSON is written
+        without indentation. Fields are encoded according to the dict of
+        storage policies `storage` (see `narwhal.storage`).
         """
         if hasattr(fnm, "write"):
-            fileio.writecast(fnm, self, binary=binary)
+            fileio.writecast(fnm, self, binary=binary, compact=compact,
+                             storage=storage)
+        elif os.path.splitext(fnm)[1] == ".nwb":
+            with open(fnm, "wb") as f:
+                fileio.writebinary(f, self, storage=storage)
+        elif os.path.splitext(fnm)[1] == ".nwd":
+            with open(fnm, "wb") as f:
+                fileio.writecastlines(f, [self], storage=storage)
+        elif os.path.splitext(fnm)[1] == ".nwx":
+            with open(fnm, "wb") as f:
+                fileio.writeblocked(f, [self], storage=storage)
         else:
             if binary:
                 if os.path.splitext(fnm)[1] != ".nwz":
                     fnm = fnm + ".nwz"
                 with gzip.open(fnm, "wb") as f:
-                    fileio.writecast(f, self, binary=True)
+                    fileio.writecast(f, self, binary=True, compact=compact,
+                                     storage=storage)
             else:
                 if os.path.splitext(fnm)[1] != ".nwl":
                     fnm = fnm + ".nwl"
                 with open(fnm, "w") as f:
-                    fileio.writecast(f, self, binary=False)
+                    fileio.writecast(f, self, binary=False, compact=compact,
+                                     storage=storage)
         return
 
-    def add_density(self, salkey="sal", tempkey="temp", preskey="pres", rhokey="rho"):
+    def append_to(self, fnm, storage=None):
+        """ Append the cast to a newline-delimited (.nwd) file at
+        `fnm::string`, creating it if necessary. """
+        fileio.appendcastlines(fnm, [self], storage=storage)
+        return
+
+    def apply_storage(self, storage):
+        """ Convert fields in place to their representation under the dict
+        of storage policies `storage`, e.g.
+
+            cast.apply_storage({"temp": storage.Float32(),
+                                "sal": storage.Quantize(0.001)})
+
+        See `narwhal.storage` for the precision guaranteed by each policy.
+        """
+        _storage.apply(self, storage)
+        return
+
+    def _derive(self, cache, name, inputs, params, func):
+        """ Return `func()`, using `cache::DerivationCache` if not None. The
+        cast coordinates are included in the cache key. """
+        if cache is None:
+            return func()
+        coords = np.array([np.nan if c is None else c for c in self.coords],
+                          dtype=np.float64)
+        inputs = [np.asarray(a) for a in inputs] + [coords]
+        return cache.cached(name, inputs, params, func)
+
+    def add_density(self, salkey="sal", tempkey="temp", preskey="pres", rhokey="rho",
+                    cache=None):
         """ Add in-situ density computed from salinity, temperature, and
         pressure to fields. Return the field name.
         
@@ -260,15 +320,21 @@ class Cast(object):
         tempkey::string             Data key to use for in-situ temperature
         preskey::string             Data key to use for pressure
         rhokey::string              Data key to use for in-situ density
+        cache::DerivationCache      Optional cache of results (see
+                                    `narwhal.cache`)
         """
         if salkey in self.fields and tempkey in self.fields and \
                 (self.zunits == units.decibar or preskey != "z"):
-            SA = gsw.sa_from_sp(self[salkey], self[preskey],
-                                [self.coords[0] for _ in self[salkey]],
-                                [self.coords[1] for _ in self[salkey]])
-            CT = gsw.ct_from_t(SA, self[tempkey], self[preskey])
-            rho = gsw.rho(SA, CT, self[preskey])
-            return self._addkeydata(rhokey, np.asarray(rho))
+            def derive():
+                SA = gsw.sa_from_sp(self[salkey], self[preskey],
+                                    [self.coords[0] for _ in self[salkey]],
+                                    [self.coords[1] for _ in self[salkey]])
+                CT = gsw.ct_from_t(SA, self[tempkey], self[preskey])
+                return np.asarray(gsw.rho(SA, CT, self[preskey]))
+            rho = self._derive(cache, "add_density",
+                               [self[salkey], self[tempkey], self[preskey]],
+                               None, derive)
+            return self._addkeydata(rhokey, rho)
         else:
             raise FieldError("add_density requires salinity, temperature, and "
                              "pressure fields")
@@ -297,7 +363,8 @@ class Cast(object):
         depth = np.cumsum(dz)
         return self._addkeydata(depthkey, depth)
 
-    def add_Nsquared(self, rhokey="rho", depthkey="z", N2key="N2", s=0.2):
+    def add_Nsquared(self, rhokey="rho", depthkey="z", N2key="N2", s=0.2,
+                     cache=None):
         """ Calculate the squared buoyancy frequency, based on in-situ density.
         Uses a smoothing spline to compute derivatives.
         
@@ -306,20 +373,27 @@ class Cast(object):
         N2key::string               Data key to use for N^2
         s::float                    Spline smoothing factor (smaller values
                                     give a noisier result)
+        cache::DerivationCache      Optional cache of results (see
+                                    `narwhal.cache`)
         """
         if rhokey not in self.fields:
             raise FieldError("add_Nsquared requires in-situ density")
-        msk = self.nanmask((rhokey, depthkey))
-        rho = self[rhokey][~msk]
-        z = self[depthkey][~msk]
-        rhospl = UnivariateSpline(z, rho, s=s)
-        drhodz = np.asarray([-rhospl.derivatives(_z)[1] for _z in z])
-        N2 = np.empty(len(self), dtype=np.float64)
-        N2[msk] = np.nan
-        N2[~msk] = -G / rho * drhodz
+        def derive():
+            msk = self.nanmask((rhokey, depthkey))
+            rho = self[rhokey][~msk]
+            z = self[depthkey][~msk]
+            rhospl = UnivariateSpline(z, rho, s=s)
+            drhodz = np.asarray([-rhospl.derivatives(_z)[1] for _z in z])
+            N2 = np.empty(len(self), dtype=np.float64)
+            N2[msk] = np.nan
+            N2[~msk] = -G / rho * drhodz
+            return N2
+        N2 = self._derive(cache, "add_Nsquared", [self[rhokey], self[depthkey]],
+                          {"s": s}, derive)
         return self._addkeydata(N2key, N2)
 
-    def baroclinic_modes(self, nmodes, ztop=10, N2key="N2", depthkey="z"):
+    def baroclinic_modes(self, nmodes, ztop=10, N2key="N2", depthkey="z",
+                         cache=None):
         """ Calculate the baroclinic normal modes based on linear
         quasigeostrophy and the vertical stratification. Return the first
         `nmodes::int` deformation radii and their associated eigenfunctions.
@@ -331,10 +405,18 @@ class Cast(object):
                                     to avoid surface effects
         N2key::string               Data key to use for N^2
         depthkey::string            Data key to use for depth
+        cache::DerivationCache      Optional cache of results (see
+                                    `narwhal.cache`)
         """
         if N2key not in self.fields or depthkey not in self.fields:
             raise FieldError("baroclinic_modes requires buoyancy frequency and depth")
+        return self._derive(cache, "baroclinic_modes",
+                            [self[N2key], self[depthkey]],
+                            {"nmodes": nmodes, "ztop": ztop},
+                            lambda: self._baroclinic_modes(nmodes, ztop, N2key,
+                                                           depthkey))
 
+    def _baroclinic_modes(self, nmodes, ztop, N2key, depthkey):
         igood = ~self.nanmask((N2key, depthkey))
         N2 = self[N2key][igood]
         dep = self[depthkey][igood]
@@ -461,6 +543,10 @@ class CastCollection(collections.Sequence):
         else:
             raise TypeError("Arguments must be either Cast types or an "
                             "iterable collection of Cast types")
+        self._proptable = None
+        self._proptable_key = None
+        self._projdist = None
+        self._projdist_key = None
         return
 
     def __len__(self):
@@ -525,19 +611,56 @@ class CastCollection(collections.Sequence):
 
     @property
     def coords(self):
-        return Multipoint([c.coords for c in self], crs=LONLAT)
+        return Multipoint(self._coordinates(), crs=LONLAT)
+
+    @property
+    def proptable(self):
+        """ A PropertyTable holding the scalar properties and coordinates of
+        all casts as columns. The table is built on first access and rebuilt
+        when casts are added or removed, or when properties are changed by
+        CastCollection methods. Edits made directly to `cast.properties` are
+        not detected.
+        """
+        key = tuple(id(c) for c in self.casts)
+        if self._proptable is None or self._proptable_key != key:
+            self._proptable = PropertyTable.fromproperties(
+                                    c.properties for c in self.casts)
+            self._proptable_key = key
+        return self._proptable
+
+    def subset(self, selection):
+        """ Return a CastCollection from a boolean mask or an array of
+        integer indices, such as one built from `proptable` columns. """
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            if len(selection) != len(self):
+                raise ValueError("boolean mask must have the same length as "
+                                 "the CastCollection")
+            selection = np.flatnonzero(selection)
+        return CastCollection([self.casts[i] for i in selection])
+
+    def between(self, key, lower=None, upper=None):
+        """ Return a CastCollection of casts with `lower <= property < upper`,
+        where `key::string` names a numerical or datetime property. Either
+        bound may be None. """
+        return self.subset(self.proptable.between(key, lower, upper))
 
     def add_bathymetry(self, bathymetry):
         """ Reference Bathymetry instance `bathymetry` to CastCollection.
 
         bathymetry::Bathymetry2d        bathymetry instance
+
+        Depths are looked up for all casts at once (see
+        `Bathymetry2d.atxy_many`). Casts without coordinates are assigned a
+        depth of NaN.
         """
-        for cast in self.casts:
-            if hasattr(cast, "coords"):
-                cast.properties["depth"] = bathymetry.atxy(*cast.coords)
-            else:
-                cast.properties["tdepth"] = np.nan
-                sys.stderr.write("Warning: cast has no coordinates")
+        lon, lat = self._lonlat()
+        depths = bathymetry.atxy_many(lon, lat)
+        if np.any(np.isnan(lon) | np.isnan(lat)):
+            warnings.warn("some casts have no coordinates")
+        for cast, depth in zip(self.casts, depths):
+            cast.properties["depth"] = float(depth)
+        self._proptable = None
         return
 
     def castwhere(self, key, value):
@@ -588,6 +711,52 @@ class CastCollection(collections.Sequence):
         casts = [self.castwhere(key, v) for v in values]
         return CastCollection(casts)
 
+    def map(self, func, executor=None, workers=None, chunksize=None,
+            sharedmem=False):
+        """ Apply `func::function` to every cast and return the results in
+        order. If every result is a Cast, a CastCollection is returned,
+        otherwise a list.
+
+        executor::string    None (serial), "thread", "process", or a
+                            `concurrent.futures.Executor` instance
+        workers::int        number of workers [default: number of CPUs]
+        chunksize::int      number of casts sent to a worker at once
+        sharedmem::bool     with a process executor, publish the collection
+                            to shared memory rather than pickling casts
+                            (requires Python 3.8+, see `narwhal.sharedmem`)
+
+        With a process executor, casts are sent to workers as plain arrays and
+        property dicts rather than as pickled DataFrames. Workers operate on
+        copies, so in-place changes to casts are only visible through the
+        values that `func` returns, and `func` must be picklable. Casts
+        received through shared memory are read-only.
+        """
+        process = executor == "process" or (futures is not None and
+                isinstance(executor, futures.ProcessPoolExecutor))
+        if process and sharedmem:
+            from . import sharedmem as shm
+            with shm.SharedCollection(self) as shared:
+                desc = shared.descriptor
+                results = _chunked_map(partial(shm._mapshared, func,
+                                               desc["name"], desc["size"]),
+                                       desc["casts"], executor=executor,
+                                       workers=workers, chunksize=chunksize)
+            results = [pickle.loads(r) for r in results]
+            results = [_unpackcast(r) if iscast else r for (iscast, r) in results]
+        elif process:
+            packed = [_packcast(c) for c in self.casts]
+            results = _chunked_map(partial(_mappacked, func), packed,
+                                   executor=executor, workers=workers,
+                                   chunksize=chunksize)
+            results = [_unpackcast(r) if iscast else r for (iscast, r) in results]
+        else:
+            results = _chunked_map(partial(_mapcasts, func), self.casts,
+                                   executor=executor, workers=workers,
+                                   chunksize=chunksize)
+        if all(isinstance(r, AbstractCast) for r in results):
+            return CastCollection(results)
+        return results
+
     def defray(self):
         """ Pad casts to all have the same length, and return a copy.
         
@@ -618,19 +787,39 @@ class CastCollection(collections.Sequence):
             arr[:len(cast), i] = cast[key]
         return arr
 
-    def projdist(self):
+    def _coordinates(self):
+        """ Return the list of cast coordinates. """
+        return [c.coords for c in self.casts]
+
+    def _lonlat(self):
+        """ Return arrays of cast longitudes and latitudes. """
+        coords = np.array(self._coordinates(), dtype=np.float64)
+        coords = coords.reshape((len(self.casts), 2))
+        return coords[:,0], coords[:,1]
+
+    def projdist(self, method="vincenty"):
         """ Return the cumulative distances from the cast to cast.
+
+        Distances are computed on the WGS 84 ellipsoid ("vincenty") or on a
+        sphere ("haversine"), and cached until the cast coordinates change.
         """
-        cumulative = [0]
-        a = Point(self.casts[0].coords, crs=LONLAT)
-        for cast in self.casts[1:]:
-            b = Point(cast.coords, crs=LONLAT)
-            cumulative.append(cumulative[-1] + a.distance(b))
-            a = b
-        return np.asarray(cumulative, dtype=np.float64)
+        key = (method, tuple(tuple(c) for c in self._coordinates()))
+        if self._projdist is None or self._projdist_key != key:
+            lons, lats = self._lonlat()
+            self._projdist = geodesy.cumulative_distance(lons, lats, method=method)
+            self._projdist_key = key
+        return self._projdist.copy()
+
+    def distance_matrix(self, chunksize=1024, method="vincenty"):
+        """ Return the matrix of distances between every pair of casts,
+        computed in blocks of `chunksize::int` rows to bound the size of
+        intermediate arrays. See also `geodesy.iter_distance_matrix`. """
+        lons, lats = self._lonlat()
+        return geodesy.distance_matrix(lons, lats, chunksize=chunksize,
+                                       method=method)
 
     def thermal_wind(self, tempkey="temp", salkey="sal", rhokey=None,
-                     dudzkey="dudz", ukey="u", overwrite=False):
+                     dudzkey="dudz", ukey="u", overwrite=False, cache=None):
         """ Compute profile-orthagonal velocity shear using hydrostatic thermal
         wind. In-situ density is computed from temperature and salinity unless
         *rhokey* is provided.
@@ -650,11 +839,13 @@ class CastCollection(collections.Sequence):
         overwrite::bool     whether to allow cast fields to be overwritten
                             if False, then *ukey* and *dudzkey* are incremented
                             until there is no clash
+        cache::DerivationCache  optional cache of derived quantities (see
+                            `narwhal.cache`)
         """
         if rhokey is None:
             rhokeys = []
             for cast in self.casts:
-                rhokeys.append(cast.add_density())
+                rhokeys.append(cast.add_density(cache=cache))
             if any(r != rhokeys[0] for r in rhokeys[1:]):
                 raise NameError("Tried to add density field, but ended up with "
                                 "different keys - aborting")
@@ -668,10 +859,20 @@ class CastCollection(collections.Sequence):
             if "z" not in cast.data.keys():
                 cast.add_depth()
 
-        drho = util.diff2_dinterp(rho, self.projdist())
-        sinphi = np.sin([c.coords[1]*np.pi/180.0 for c in self.casts])
-        dudz = (G / rho * drho) / (2*OMEGA*sinphi)
-        u = util.uintegrate(dudz, self.asarray("z"))
+        def derive():
+            drho = util.diff2_dinterp(rho, self.projdist())
+            sinphi = np.sin([c.coords[1]*np.pi/180.0 for c in self.casts])
+            dudz = (G / rho * drho) / (2*OMEGA*sinphi)
+            u = util.uintegrate(dudz, self.asarray("z"))
+            return dudz, u
+
+        if cache is None:
+            dudz, u = derive()
+        else:
+            lon, lat = self._lonlat()
+            dudz, u = cache.cached("thermal_wind",
+                                   [rho, self.asarray("z"), lon, lat],
+                                   None, derive)
 
         for (ic,cast) in enumerate(self.casts):
             cast._addkeydata(dudzkey, dudz[:,ic], overwrite=overwrite)
@@ -680,7 +881,7 @@ class CastCollection(collections.Sequence):
 
     def thermal_wind_inner(self, tempkey="temp", salkey="sal", rhokey=None,
                            dudzkey="dudz", ukey="u", bottomkey="depth",
-                           overwrite=False):
+                           overwrite=False, cache=None):
         """ Alternative implementation that creates a new cast collection
         consistng of points between the observation casts.
 
@@ -703,11 +904,13 @@ class CastCollection(collections.Sequence):
         overwrite::bool     whether to allow cast fields to be overwritten
                             if False, then *ukey* and *dudzkey* are incremented
                             until there is no clash
+        cache::DerivationCache  optional cache of derived quantities (see
+                            `narwhal.cache`)
         """
         if rhokey is None:
             rhokeys = []
             for cast in self.casts:
-                rhokeys.append(cast.add_density())
+                rhokeys.append(cast.add_density(cache=cache))
             if any(r != rhokeys[0] for r in rhokeys[1:]):
                 raise NameError("Tried to add density field, but ended up with "
                                 "different keys - aborting")
@@ -749,7 +952,8 @@ class CastCollection(collections.Sequence):
         return coll
 
 
-    def eofs(self, key="temp", n_eofs=None):
+    def eofs(self, key="temp", n_eofs=None, method="full", random_state=None,
+             batchsize=100):
         """ Compute the EOFs and EOF structures for *key*. Returns a cast with
         the structure functions, an array of eigenvectors (EOFs), and an array
         of eigenvalues.
@@ -760,22 +964,54 @@ class CastCollection(collections.Sequence):
         ----------
 
         key::string     key to use for computing EOFs
-        n_eofs::int     number of EOFs to return
+        n_eofs::int     number of EOFs to return, at most the number of
+                        casts or of levels without NaNs [default: all]
+        method::string  "full" computes the complete singular value
+                        decomposition, while "truncated" (ARPACK) and
+                        "randomized" compute only the leading *n_eofs* modes,
+                        at a cost that scales with *n_eofs*. All methods
+                        return the leading right singular vectors as columns,
+                        and structure functions that are the projections of
+                        the data onto them. "incremental"
+                        streams casts in batches of *batchsize*, and is
+                        described in `eofs_incremental`.
+        random_state::int   seed for the "randomized" method
+        batchsize::int      number of casts per batch for the "incremental"
+                            method
         """
-        assert all(self[0].zname == c.zname for c in self[1:])
-        assert all(all(self[0].data.index == c.data.index) for c in self[1:])
+        if method == "incremental":
+            return eofs_incremental(self, key=key, n_eofs=n_eofs,
+                                    batchsize=batchsize)
 
-        if n_eofs is None:
-            n_eofs = len(self)
+        if len(set(c.zname for c in self.casts)) != 1 or \
+                len(set(len(c) for c in self.casts)) != 1 or \
+                np.any(np.vstack([c[c.zname].values for c in self.casts]) !=
+                       self.casts[0][self.casts[0].zname].values):
+            raise ValueError("EOFs require all casts to have the same "
+                             "depth-gridding")
 
         arr = self.asarray(key)
-        msk = reduce(lambda a,b:a|b, (c.nanmask(key) for c in self))
+        msk = np.any(np.isnan(arr), axis=1)
         arr = arr[~msk,:]
         arr -= arr.mean()
 
-        _,sigma,V = np.linalg.svd(arr)
-        lamb = sigma**2/(len(self)-1)
+        # there are at most as many modes as casts or levels
+        if n_eofs is None:
+            n_eofs = len(self)
+        n_eofs = min(n_eofs, *arr.shape)
+
+        if method == "full":
+            _,sigma,Vh = np.linalg.svd(arr, full_matrices=False)
+        elif method == "truncated":
+            _,sigma,Vh = util.truncated_svd(arr, n_eofs)
+        elif method == "randomized":
+            _,sigma,Vh = util.randomized_svd(arr, n_eofs,
+                                             random_state=random_state)
+        else:
+            raise ValueError("EOF method '{0}' not recognized".format(method))
+        V = Vh.T
         eofts = util.eof_timeseries(arr, V)
+        lamb = sigma**2/(len(self)-1)
 
         c0 = self[0]
         c = Cast(c0[c0.zname][~msk], coords=(np.nan, np.nan),
@@ -784,39 +1020,667 @@ class CastCollection(collections.Sequence):
             c._addkeydata("_eof".join([key, str(i+1)]), eofts[:,i])
         return c, lamb[:n_eofs], V[:,:n_eofs]
 
-    def save(self, fnm, binary=True):
-        """ Save a JSON-formatted representation to a file.
-
-        fnm::string     File name to save to
+    def save(self, fnm, binary=True, compact=False, storage=None):
+        """ Save a JSON-formatted representation to a file. Casts are
+        serialized one at a time.
+
+        fnm::string     File name to save to. Names ending in ".nwb" are
+                        written in the binary columnar format instead (see
+                        `fileio.writebinary`), names ending in ".nwd" in the
+                        newline-delimited format (see `append_to`), and names
+                        ending in ".nwx" in the blocked gzip format, which
+                        supports random access (see `read`)
+        binary::bool    Whether to write gzip-compressed JSON (default True)
+        compact::bool   Whether to omit JSON indentation (default False)
+        storage::dict   Storage policies by field name (see `narwhal.storage`)
         """
         if hasattr(fnm, "write"):
-            fileio.writecastcollection(fnm, self, binary=binary)
+            fileio.writecastcollection(fnm, self, binary=binary, compact=compact,
+                                       storage=storage)
+        elif os.path.splitext(fnm)[1] == ".nwb":
+            with open(fnm, "wb") as f:
+                fileio.writebinary(f, self, storage=storage)
+        elif os.path.splitext(fnm)[1] == ".nwd":
+            with open(fnm, "wb") as f:
+                fileio.writecastlines(f, self, storage=storage)
+        elif os.path.splitext(fnm)[1] == ".nwx":
+            with open(fnm, "wb") as f:
+                fileio.writeblocked(f, self, storage=storage)
         else:
             if binary:
                 if os.path.splitext(fnm)[1] != ".nwz":
                     fnm = fnm + ".nwz"
                 with gzip.open(fnm, "wb") as f:
-                    fileio.writecastcollection(f, self, binary=True)
+                    fileio.writecastcollection(f, self, binary=True, compact=compact,
+                                               storage=storage)
             else:
                 if os.path.splitext(fnm)[1] != ".nwl":
                     fnm = fnm + ".nwl"
                 with open(fnm, "w") as f:
-                    fileio.writecastcollection(f, self, binary=False)
+                    fileio.writecastcollection(f, self, binary=False, compact=compact,
+                                               storage=storage)
+        return
+
+    def append_to(self, fnm, storage=None):
+        """ Append casts to a newline-delimited (.nwd) file at `fnm::string`,
+        creating it if necessary.
+
+        In the newline-delimited format, each line holds one cast, so that
+        casts can be appended without rewriting the file and the file can be
+        parsed in parallel (see `read`).
+        """
+        fileio.appendcastlines(fnm, self, storage=storage)
+        return
+
+    def apply_storage(self, storage):
+        """ Convert the fields of each cast in place to their representation
+        under the dict of storage policies `storage` (see `narwhal.storage`).
+        """
+        for cast in self.casts:
+            _storage.apply(cast, storage)
+        return
+
+    def to_frame(self, properties=True, castid="cast"):
+        """ Return a long-format DataFrame with one row per level of every
+        cast.
+
+        properties::bool or list    scalar properties to include as columns,
+                                    broadcast over the levels of each cast
+                                    [default True: all]. Coordinates become
+                                    "lon" and "lat" columns, and string
+                                    properties become categoricals.
+        castid::string              name of the column holding the index of
+                                    each cast [default "cast"]
+
+        Fields are padded with NaN in casts that lack them. Float64 fields are
+        written into a single preallocated block that backs the DataFrame
+        without further copying. See also `CastCollection.from_frame`.
+        """
+        counts = np.array([len(c.data) for c in self.casts], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        fields = []
+        for cast in self.casts:
+            for key in [cast.zname] + cast.fields:
+                if key not in fields:
+                    fields.append(key)
+        floatfields = [k for k in fields
+                       if all(c.data[k].dtype == np.float64
+                              for c in self.casts if k in c.data)]
+
+        block = np.full((len(floatfields), offsets[-1]), np.nan)
+        for j, key in enumerate(floatfields):
+            for i, cast in enumerate(self.casts):
+                if key in cast.data:
+                    block[j, offsets[i]:offsets[i+1]] = cast.data[key].values
+        columns = dict((k, _concatfield(self.casts, k, offsets))
+                       for k in fields if k not in floatfields)
+        columns[castid] = np.repeat(np.arange(len(self.casts)), counts)
+
+        table = self.proptable
+        if properties is True:
+            properties = table.keys()
+        elif properties is False or properties is None:
+            properties = []
+        for key in properties:
+            if key in columns or key in floatfields:
+                raise ValueError("property '{0}' conflicts with a column of "
+                                 "the same name".format(key))
+            col = table[key]
+            if col.dtype == object:
+                try:
+                    codes, categories = pandas.factorize(col)
+                    columns[key] = pandas.Categorical.from_codes(
+                                    np.repeat(codes, counts), categories)
+                    continue
+                except TypeError:
+                    pass    # unhashable values
+            columns[key] = np.repeat(col, counts)
+
+        order = [castid] + list(properties) + fields
+        return fileio.framefromblocks([(floatfields, block)], columns, order)
+
+    @classmethod
+    def from_frame(cls, df, by="cast", zname=None, zunits=units.meter,
+                   properties=None):
+        """ Split a long-format DataFrame into casts.
+
+        df::DataFrame           long-format data, as from `to_frame`
+        by::string              column identifying the cast of each row
+        zname::string           vertical coordinate column [default: first
+                                column that varies within a cast]
+        zunits::Unit            units of the vertical coordinate
+        properties::list        columns holding scalar properties [default:
+                                columns preceding `zname` that are constant
+                                within every cast, as written by `to_frame`]
+
+        Casts are ordered by first appearance in `by`. Rows of each cast are
+        located by a scan for changes in `by` rather than by grouping, so that
+        casts stored contiguously are split without sorting. Property values
+        are taken from the first row of each cast; "lon" and "lat" become
+        coordinates. Float64 fields of each cast are views of one array.
+        """
+        codes = pandas.factorize(df[by].values)[0]
+        if np.any(codes[1:] < codes[:-1]):
+            order = np.argsort(codes, kind="mergesort")
+            df = df.iloc[order]
+            codes = codes[order]
+        isstart = np.ones(len(codes), dtype=bool)
+        isstart[1:] = codes[1:] != codes[:-1]
+        offsets = np.append(np.flatnonzero(isstart), len(codes))
+
+        columns = [c for c in df.columns if c != by]
+        if zname is None:
+            varying = [c for c in columns if c not in (properties or []) and
+                       not _isconstantruns(df[c].values, isstart)]
+            if len(varying) == 0:
+                raise ValueError("vertical coordinate could not be identified")
+            zname = varying[0]
+        if properties is None:
+            properties = [c for c in columns[:columns.index(zname)]
+                          if _isconstantruns(df[c].values, isstart)]
+        fields = [c for c in columns if c not in properties]
+
+        floatfields = [k for k in fields if df[k].dtype == np.float64]
+        floatvalues = df[floatfields].values
+        othervalues = dict((k, np.asarray(df[k].values)) for k in fields
+                           if k not in floatfields)
+        propvalues = [(k, np.asarray(df[k].values)) for k in properties]
+
+        casts = []
+        for a, b in zip(offsets[:-1], offsets[1:]):
+            data = fileio.framefromblocks(
+                        [(floatfields, floatvalues[a:b].T)],
+                        dict((k, v[a:b]) for (k, v) in othervalues.items()),
+                        fields)
+            prop = {}
+            for k, v in propvalues:
+                value = _pyscalar(v[a])
+                if value is not None:
+                    prop[k] = value
+            prop["coordinates"] = (prop.pop("lon", None), prop.pop("lat", None))
+            casts.append(_castfromframe(data, zname, zunits, prop))
+        return cls(casts)
+
+    def to_netcdf(self, fnm):
+        """ Save casts to a NetCDF file at `fnm::string`, following the CF
+        conventions for profiles stored in a contiguous ragged array. Casts
+        must share the same vertical coordinate. See `fileio.writeragged`.
+        """
+        fileio.writeragged(fnm, self)
         return
 
+    def to_geojson(self, fnm, properties=()):
+        """ Write cast locations to a GeoJSON file at `fnm::string` (or a
+        binary stream), with the scalar properties named in `properties` and
+        summary statistics of each cast. Casts are written in chunks; see
+        `fileio.writegeojson`.
+        """
+        if hasattr(fnm, "write"):
+            fileio.writegeojson(fnm, self, properties=properties)
+        else:
+            with open(fnm, "wb") as f:
+                fileio.writegeojson(f, self, properties=properties)
+        return
+
+
+def _concatfield(casts, key, offsets):
+    """ Concatenate field `key` over casts, padding casts that lack it. """
+    parts = [c.data[key].values if key in c.data else None for c in casts]
+    dtype = np.result_type(*[p.dtype for p in parts if p is not None])
+    if any(p is None for p in parts):
+        if dtype.kind in "biu":
+            dtype = np.dtype(np.float64)
+        elif dtype.kind not in "fcmMO":
+            dtype = np.dtype(object)
+    col = np.empty(offsets[-1], dtype=dtype)
+    for i, part in enumerate(parts):
+        if part is None:
+            col[offsets[i]:offsets[i+1]] = None if dtype.kind == "O" else \
+                    np.array("NaT", dtype=dtype) if dtype.kind in "mM" else np.nan
+        else:
+            col[offsets[i]:offsets[i+1]] = part
+    return col
+
+def _isconstantruns(values, isstart):
+    """ Return whether `values` is constant within each run of rows delimited
+    by `isstart`, treating missing values as equal. """
+    values = np.asarray(values)
+    if len(values) < 2:
+        return True
+    inner = ~isstart[1:]
+    a, b = values[1:][inner], values[:-1][inner]
+    nulls = pandas.isnull(a) & pandas.isnull(b)
+    return bool(np.all((a == b) | nulls))
+
+def _pyscalar(value):
+    """ Convert a numpy scalar to a Python object, and missing values to
+    None. """
+    if value is None or (np.ndim(value) == 0 and pandas.isnull(value)):
+        return None
+    if isinstance(value, np.datetime64):
+        return pandas.Timestamp(value).to_pydatetime()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _castfromarrays(arrays, zname, zunits, properties, copy=True):
+    """ Construct a Cast from an ordered sequence of (field, array) pairs and a
+    property dict, bypassing keyword parsing. With *copy* False, the arrays
+    are wrapped rather than copied where pandas allows it. """
+    arrays = list(arrays)
+    data = pandas.DataFrame(dict(arrays), columns=[k for k, _ in arrays],
+                            copy=copy)
+    return _castfromframe(data, zname, zunits, properties)
+
+def _castfromframe(data, zname, zunits, properties):
+    """ Construct a Cast around an existing DataFrame without copying it. """
+    cast = Cast.__new__(Cast)
+    cast.properties = properties
+    cast.p = cast.properties
+    cast.zunits = zunits
+    cast.zname = zname
+    cast.data = data
+    return cast
+
+def _packcast(cast):
+    """ Return a compact picklable representation of a cast. """
+    return (cast.zname, cast.zunits, cast.properties,
+            [(k, cast.data[k].values) for k in cast.fields])
+
+def _unpackcast(packed):
+    (zname, zunits, properties, arrays) = packed
+    return _castfromarrays(arrays, zname, zunits, properties, copy=False)
+
+def _mapcasts(func, casts):
+    return [func(c) for c in casts]
+
+def _packresults(results):
+    """ Pack the Cast instances in a list of results, returning a list of
+    (iscast, value) pairs. """
+    return [(True, _packcast(r)) if isinstance(r, AbstractCast) else (False, r)
+            for r in results]
+
+def _mappacked(func, packed):
+    """ Worker-side counterpart of CastCollection.map for packed casts. """
+    return _packresults([func(_unpackcast(p)) for p in packed])
+
+def _chunked_map(func, items, executor="process", workers=None, chunksize=None):
+    """ Apply `func`, which takes and returns a list, to chunks of `items`
+    using an executor, and return the concatenated results in order.
+
+    executor may be None (serial), "thread", "process", or an instance of
+    `concurrent.futures.Executor`.
+    """
+    items = list(items)
+    if executor is None:
+        return func(items)
+    if futures is None:
+        raise ImportError("parallel execution requires concurrent.futures")
+
+    if isinstance(executor, futures.Executor):
+        pool = executor
+    elif executor == "process":
+        pool = futures.ProcessPoolExecutor(max_workers=workers)
+    elif executor == "thread":
+        pool = futures.ThreadPoolExecutor(
+                max_workers=workers or multiprocessing.cpu_count())
+    else:
+        raise ValueError("executor must be None, 'thread', 'process', or an "
+                         "Executor instance")
 
-def read(fnm):
+    if chunksize is None:
+        nworkers = workers or multiprocessing.cpu_count()
+        chunksize = max(1, -(-len(items) // (4*nworkers)))
+    chunks = [items[i:i+chunksize] for i in range(0, len(items), chunksize)]
+    try:
+        results = list(pool.map(func, chunks))
+    finally:
+        if pool is not executor:
+            pool.shutdown()
+    return list(itertools.chain.from_iterable(results))
+
+def _itercasts(source):
+    """ Yield casts from a CastCollection, an iterable of casts, or an
+    iterable of filenames (each containing a cast or a collection). """
+    for item in source:
+        if isinstance(item, six.string_types):
+            item = read(item)
+        if isinstance(item, AbstractCastCollection):
+            for cast in item:
+                yield cast
+        else:
+            yield item
+
+def _batches(iterable, n):
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if len(batch) == 0:
+            return
+        yield batch
+
+def eofs_incremental(source, key="temp", n_eofs=None, batchsize=100):
+    """ Compute EOFs for *key* without holding all casts in memory at once.
+    Returns a cast with the structure functions, an array of eigenvalues, and
+    an array of eigenvectors, as `CastCollection.eofs`.
+
+    Casts are streamed in batches of *batchsize* to accumulate the
+    level-by-level covariance matrix, which is then decomposed. A second pass
+    recovers the eigenvectors (one row per cast), so *source* must be
+    re-iterable: a CastCollection (possibly lazily loaded), a sequence of
+    casts, or a sequence of filenames.
+
+    The structure functions are the projections of the data onto the leading
+    eigenvectors, matching the "truncated" method of `CastCollection.eofs`.
+    Memory use scales with the square of the number of depth levels, rather
+    than with the number of casts.
+    """
+    if iter(source) is source:
+        raise TypeError("source must be re-iterable (not an iterator)")
+
+    c0 = None
+    for batch in _batches(_itercasts(source), batchsize):
+        if c0 is None:
+            c0 = batch[0]
+            nlevels = len(c0)
+            z0 = c0[c0.zname].values
+            G = np.zeros((nlevels, nlevels), dtype=np.float64)
+            rowsums = np.zeros(nlevels, dtype=np.float64)
+            nanrows = np.zeros(nlevels, dtype=bool)
+            ncasts = 0
+        if any(c.zname != c0.zname or len(c) != nlevels or
+               np.any(c[c.zname].values != z0) for c in batch):
+            raise ValueError("EOFs require all casts to have the same "
+                             "depth-gridding")
+        X = np.column_stack([c[key].values for c in batch])
+        nans = np.isnan(X)
+        nanrows |= np.any(nans, axis=1)
+        X[nans] = 0.0
+        G += np.dot(X, X.T)
+        rowsums += X.sum(axis=1)
+        ncasts += X.shape[1]
+
+    if c0 is None:
+        raise ValueError("no casts in source")
+    if n_eofs is None:
+        n_eofs = ncasts
+
+    # Remove the mean over all retained data from the accumulated products
+    keep = ~nanrows
+    G = G[keep][:,keep]
+    rowsums = rowsums[keep]
+    mean = rowsums.sum() / (keep.sum() * ncasts)
+    G -= mean * (rowsums[:,np.newaxis] + rowsums[np.newaxis,:])
+    G += mean**2 * ncasts
+
+    w, U = np.linalg.eigh(G)
+    order = np.argsort(w)[::-1][:n_eofs]
+    sigma = np.sqrt(np.clip(w[order], 0.0, None))
+    U = U[:,order]
+    lamb = sigma**2 / (ncasts-1)
+
+    # Second pass for the eigenvectors
+    V = np.empty((ncasts, len(sigma)), dtype=np.float64)
+    i = 0
+    scale = np.where(sigma == 0.0, 0.0, 1.0 / np.where(sigma == 0.0, 1.0, sigma))
+    for batch in _batches(_itercasts(source), batchsize):
+        Y = np.column_stack([c[key].values for c in batch])[keep] - mean
+        V[i:i+Y.shape[1]] = np.dot(Y.T, U) * scale
+        i += Y.shape[1]
+
+    c = Cast(c0[c0.zname].values[keep], coords=(np.nan, np.nan),
+             zunits=c0.zunits, zname=c0.zname)
+    for i in range(len(sigma)):
+        c._addkeydata("_eof".join([key, str(i+1)]), U[:,i]*sigma[i])
+    return c, lamb, V
+
+def read(fnm, workers=None, index=None, where=None):
     """ Convenience function for reading JSON-formatted measurement data from
     `fnm::string`.
+
+    Files in the binary .nwb format are detected automatically and
+    memory-mapped, so that cast data are read-only views of the file.
+
+    Newline-delimited (.nwd) files are read as a CastCollection. If
+    `workers::int` is given, the file is split into byte ranges that are
+    parsed in parallel by worker processes.
+
+    Individual casts may be selected with either of
+
+    index::int or Sequence      position(s) of casts to return; an integer
+                                returns a Cast, and a sequence a
+                                CastCollection
+    where::function             predicate on the cast properties dict,
+                                returning a CastCollection of matching casts
+
+    For blocked gzip (.nwx) files, selections are resolved from the file
+    index and only the blocks holding selected casts are decompressed.
     """
+    if index is not None and where is not None:
+        raise ValueError("at most one of `index` and `where` may be given")
+    with open(fnm, "rb") as f:
+        fmt = fileio.sniff(f, fnm)
+        if fmt == "nwx":
+            return _readblocked(fnm, index=index, where=where)
+        obj = DECODERS[fmt](fnm, f, workers=workers)
+
+    if index is None and where is None:
+        return obj
+    casts = [obj] if isinstance(obj, AbstractCast) else obj
+    indices, single = _selection(len(casts), lambda i: casts[i].properties,
+                                 index, where)
+    if single:
+        return casts[indices[0]]
+    return CastCollection([casts[i] for i in indices])
+
+def _decodejson(fnm, f, workers=None):
+    s = f.read()
+    try:
+        return _fromjson(fileio.loads(s))
+    except ValueError:
+        # newline-delimited files without the .nwd extension hold several
+        # documents, the first of which is complete
+        if not _isjson(s.split(b"\n", 1)[0]):
+            raise
+        return _readcastlines(fnm, workers)
+
+def _isjson(s):
+    try:
+        fileio.loads(s)
+    except ValueError:
+        return False
+    return True
+
+def _decodegzip(fnm, f, workers=None):
+    with gzip.GzipFile(fileobj=f, mode="rb") as g:
+        return _fromjson(fileio.loads(g.read()))
+
+def _decodebinary(fnm, f, workers=None):
+    typ, casts = fileio.readbinary(f, _castfromframe)
+    return casts[0] if typ == "cast" else CastCollection(casts)
+
+def _decodelines(fnm, f, workers=None):
+    return _readcastlines(fnm, workers)
+
+def _decodenetcdf(fnm, f, workers=None):
+    nc = fileio.opennetcdf(f)
+    if fileio.isragged(nc):
+        return read_netcdf(nc)
+    return read_woce_netcdf(nc)
+
+def _decodehdf5(fnm, f, workers=None):
+    raise IOError("{0} is a NetCDF4/HDF5 file, which is not supported; only "
+                  "NetCDF3 files can be read".format(fnm))
+
+# Functions reading narwhal objects from files of each format identified by
+# `fileio.sniff`, called as func(fnm, f, workers=None) with the file open for
+# binary reading as `f`.
+DECODERS = {"json": _decodejson,
+            "gzip": _decodegzip,
+            "nwb": _decodebinary,
+            "ndjson": _decodelines,
+            "netcdf": _decodenetcdf,
+            "hdf5": _decodehdf5}
+
+def _selection(n, properties, index, where):
+    """ Resolve an `index` or `where` selection among `n::int` casts, where
+    `properties(i)` returns the properties of cast `i`. Returns a list of
+    indices and whether a single cast was requested. """
+    if where is not None:
+        return [i for i in range(n) if where(properties(i))], False
+    if isinstance(index, numbers.Integral):
+        if not -n <= index < n:
+            raise IndexError("cast index {0} out of range".format(index))
+        return [index % n], True
+    return [range(n)[i] for i in index], False
+
+def _readblocked(fnm, index=None, where=None):
+    reader = fileio.BlockedReader(fnm)
     try:
-        with open(fnm, "r") as f:
-            d = json.load(f)
-    except (UnicodeDecodeError,ValueError) as e:
-        with gzip.open(fnm, "rb") as f:
-            s = f.read().decode("utf-8")
-            d = json.loads(s)
-    return _fromjson(d)
+        if index is None and where is None:
+            indices, single = list(range(len(reader))), False
+        else:
+            indices, single = _selection(len(reader), reader.properties,
+                                         index, where)
+        casts = [_fromjson(reader.castdict(i)) for i in indices]
+    finally:
+        reader.close()
+    return casts[0] if single else CastCollection(casts)
+
+def _expandpaths(paths, extensions=fileio.EXTENSIONS):
+    """ Expand a glob pattern, directory, or sequence of these into a list of
+    file names. Directories contribute their files with `extensions`. """
+    if isinstance(paths, six.string_types):
+        paths = [paths]
+    fnms = []
+    for path in paths:
+        if os.path.isdir(path):
+            fnms.extend(sorted(os.path.join(path, f) for f in os.listdir(path)
+                               if os.path.splitext(f)[1] in extensions))
+        elif glob.has_magic(path):
+            fnms.extend(sorted(glob.glob(path)))
+        else:
+            fnms.append(path)
+    return fnms
+
+def _readfiles(reader, fnms):
+    """ Read files with `reader`, returning for each a (fnm, packed casts,
+    exception) tuple. """
+    results = []
+    for fnm in fnms:
+        try:
+            obj = reader(fnm)
+            casts = [obj] if isinstance(obj, AbstractCast) else obj
+            results.append((fnm, [_packcast(c) for c in casts], None))
+        except Exception as e:
+            results.append((fnm, None, e))
+    return results
+
+def _readmany(reader, fnms, workers, sortby, errors):
+    if errors not in ("raise", "warn", "ignore"):
+        raise ValueError("errors must be 'raise', 'warn', or 'ignore'")
+    executor = None if (workers == 1 or len(fnms) < 2) else "process"
+    results = _chunked_map(partial(_readfiles, reader), fnms,
+                           executor=executor, workers=workers)
+
+    casts = []
+    for fnm, packed, error in results:
+        if error is None:
+            casts.extend(_unpackcast(p) for p in packed)
+        elif errors == "raise":
+            raise error
+        elif errors == "warn":
+            warnings.warn("failed to read {0}: {1}".format(fnm, error))
+
+    if sortby is not None:
+        if hasattr(sortby, "__call__"):
+            casts.sort(key=sortby)
+        else:
+            casts.sort(key=lambda c: c.properties[sortby])
+    return CastCollection(casts)
+
+def read_many(paths, workers=None, sortby=None, errors="warn"):
+    """ Read casts from many files into a single CastCollection, parsing files
+    in parallel worker processes.
+
+    paths::string or Iterable   glob pattern, directory, or sequence of file
+                                names, patterns, and directories
+    workers::int                number of worker processes [default: number of
+                                CPUs]; with 1, files are read serially
+    sortby::string or function  property name or key function of casts to sort
+                                by [default: file order, then order within
+                                files]
+    errors::string              handling of files that cannot be read: "raise",
+                                "warn" (default) to skip them with a warning,
+                                or "ignore" to skip them silently
+    """
+    return _readmany(read, _expandpaths(paths), workers, sortby, errors)
+
+def _readlineranges(fnm, ranges):
+    """ Parse the casts in byte ranges of a newline-delimited file, returning
+    them packed for transfer from worker processes. """
+    casts = []
+    with open(fnm, "rb") as f:
+        for (start, end) in ranges:
+            casts.extend(_packcast(_fromjson(d))
+                         for (_, _, d) in fileio.itercastlines(f, start, end))
+    return casts
+
+def _readcastlines(fnm, workers=None):
+    if workers is None or workers == 1:
+        ranges = [(0, None)]
+        executor = None
+    else:
+        ranges = fileio.linesplits(fnm, 4*workers)
+        executor = "process"
+    packed = _chunked_map(partial(_readlineranges, fnm), ranges,
+                          executor=executor, workers=workers, chunksize=1)
+    return CastCollection([_unpackcast(p) for p in packed])
+
+def iterread(fnm):
+    """ Generate the casts stored in `fnm::string` one at a time.
+
+    Collections are parsed incrementally, so that memory use is bounded by
+    the size of a single cast. A file holding a single cast yields that cast.
+    """
+    with open(fnm, "rb") as f:
+        fmt = fileio.sniff(f, fnm)
+    if fmt == "nwb":
+        header, start = fileio.readbinaryheader(fnm)
+        data = fileio.mapbinarydata(fnm, start)
+        for h in header["casts"]:
+            yield fileio.binaryascast(h, data, _castfromframe)
+    elif fmt == "nwx":
+        reader = fileio.BlockedReader(fnm)
+        try:
+            for i in range(len(reader)):
+                yield _fromjson(reader.castdict(i))
+        finally:
+            reader.close()
+    elif fmt == "ndjson":
+        with open(fnm, "rb") as f:
+            for (_, _, d) in fileio.itercastlines(f):
+                yield _fromjson(d)
+    elif fmt == "netcdf" and fileio.isragged(fnm):
+        reader = fileio.RaggedReader(fnm)
+        try:
+            for i in range(len(reader)):
+                yield _raggedcast(reader, i)
+        finally:
+            reader.close()
+    elif fmt in ("json", "gzip"):
+        f = fileio.openjson(fnm)
+        try:
+            for (_, _, d) in fileio.scancasts(f):
+                yield _fromjson(d)
+        finally:
+            f.close()
+    else:
+        with open(fnm, "rb") as f:
+            obj = DECODERS[fmt](fnm, f)
+        for cast in ([obj] if isinstance(obj, AbstractCast) else obj):
+            yield cast
 
 def _fromjson(d):
     """ Lower level function to (possibly recursively) convert JSON into
@@ -838,31 +1702,106 @@ def _fromjson(d):
     else:
         raise LookupError("Invalid type: {0}".format(typ))
 
-def read_woce_netcdf(fnm):
-    """ Read a CTD cast from a WOCE NetCDF file. """
-
-    def getvariable(nc, key):
-        return nc.variables[key].data.copy()
-
-    nc = netcdf_file(fnm)
-    coords = (getvariable(nc, "longitude")[0], getvariable(nc, "latitude")[0])
-
-    pres = getvariable(nc, "pressure")
-    sal = getvariable(nc, "salinity")
-    salqc = getvariable(nc, "salinity_QC")
-    sal[salqc!=2] = np.nan
-    temp = getvariable(nc, "temperature")
-    # tempqc = getvariable(nc, "temperature_QC")
-    # temp[tempqc!=2] = np.nan
-    oxy = getvariable(nc, "oxygen")
-    oxyqc = getvariable(nc, "oxygen_QC")
-    oxy[oxyqc!=2] = np.nan
-
-    date = getvariable(nc, "woce_date")
-    time = getvariable(nc, "woce_time")
-    return narwhal.CTDCast(pres, sal, temp, oxygen=oxy,
-                           coords=coords,
-                           properties={"woce_time":time, "woce_date":date})
+def _raggedcast(reader, i):
+    return _castfromarrays(reader.castarrays(i), reader.zname, reader.zunits,
+                           dict(reader.properties(i)), copy=False)
+
+def read_netcdf(fnm, index=None):
+    """ Read casts from a NetCDF file of CF profiles in a contiguous ragged
+    array, as written by `CastCollection.to_netcdf`. The file is
+    memory-mapped, so that reading selected casts with `index::int or
+    Sequence` reads only their rows. `fnm` may also be an open netcdf_file
+    (see `fileio.opennetcdf`).
+    """
+    reader = fileio.RaggedReader(fnm)
+    try:
+        if index is None:
+            return CastCollection([_raggedcast(reader, i)
+                                   for i in range(len(reader))])
+        elif isinstance(index, numbers.Integral):
+            return _raggedcast(reader, index)
+        return CastCollection([_raggedcast(reader, i) for i in index])
+    finally:
+        reader.close()
+
+# WOCE quality flags of acceptable measurements
+WOCE_GOOD_FLAGS = (2,)
+
+# WOCE NetCDF variables read into casts, and global attributes read into
+# properties
+_WOCE_VARIABLES = (("salinity", "sal"),
+                   ("temperature", "temp"),
+                   ("oxygen", "oxygen"))
+_WOCE_ATTRIBUTES = (("EXPOCODE", "expocode"),
+                    ("STATION_NUMBER", "station"),
+                    ("CAST_NUMBER", "cast"))
+
+def _woce_datetime(date, time):
+    """ Convert a WOCE date (YYYYMMDD) and time (HHMM) to a datetime. """
+    date, time = int(date), int(time)
+    return datetime.datetime(date // 10000, date // 100 % 100, date % 100,
+                             time // 100 % 100, time % 100)
+
+def _woce_variable(nc, key, goodflags):
+    """ Return a float64 copy of a variable from a (memory-mapped) NetCDF file,
+    with fill values and measurements flagged as bad replaced by NaN. """
+    var = nc.variables[key]
+    values = var.data.astype(np.float64)
+    fill = getattr(var, "_FillValue", None)
+    if fill is not None:
+        values[var.data == fill] = np.nan
+    if goodflags is not None and (key + "_QC") in nc.variables:
+        values[~np.isin(nc.variables[key + "_QC"].data, goodflags)] = np.nan
+    return values
+
+def read_woce_netcdf(fnm, goodflags=WOCE_GOOD_FLAGS):
+    """ Read a CTD cast from a WOCE NetCDF file.
+
+    The file is memory-mapped. Salinity, temperature, and oxygen measurements
+    with quality flags not in `goodflags::Container`, as well as fill values,
+    are replaced by NaN. If `goodflags` is None, quality flags are ignored.
+    The WOCE date and time are combined into a datetime "date" property.
+    `fnm` may also be an open netcdf_file (see `fileio.opennetcdf`).
+    """
+    nc = fileio.opennetcdf(fnm)
+    try:
+        coords = (float(nc.variables["longitude"].data[0]),
+                  float(nc.variables["latitude"].data[0]))
+        pres = _woce_variable(nc, "pressure", None)
+        fields = {}
+        for (ncname, name) in _WOCE_VARIABLES:
+            if ncname in nc.variables:
+                fields[name] = _woce_variable(nc, ncname, goodflags)
+        properties = {}
+        if "woce_date" in nc.variables:
+            time = nc.variables["woce_time"].data[0] \
+                    if "woce_time" in nc.variables else 0
+            properties["date"] = _woce_datetime(nc.variables["woce_date"].data[0],
+                                                time)
+        for (attr, name) in _WOCE_ATTRIBUTES:
+            value = getattr(nc, attr, None)
+            if value is not None:
+                if isinstance(value, bytes):
+                    value = value.decode("ascii", "replace").strip()
+                properties[name] = value
+    finally:
+        nc.close()
+
+    sal = fields.pop("sal", np.nan*np.empty_like(pres))
+    temp = fields.pop("temp", np.nan*np.empty_like(pres))
+    fields.update(properties)
+    return CTDCast(pres, sal, temp, coords=coords, **fields)
+
+def read_woce_many(paths, workers=None, goodflags=WOCE_GOOD_FLAGS, sortby=None,
+                   errors="warn"):
+    """ Read casts from many WOCE NetCDF files into a CastCollection, in
+    parallel worker processes. Arguments are as for `read_many`, except that
+    directories contribute their ".nc" files, and `goodflags` is passed to
+    `read_woce_netcdf`.
+    """
+    reader = partial(read_woce_netcdf, goodflags=goodflags)
+    return _readmany(reader, _expandpaths(paths, extensions=(".nc",)),
+                     workers, sortby, errors)
 
 class AbstractCast(six.with_metaclass(abc.ABCMeta)):
     pass
@@ -1,27 +1,80 @@
 """ Module for handling the serialization of Cast- and CastCollection-like
 objects to persistent files. """
 
+import os
 import six
+import re
+import struct
 import json
+import gzip
+import zlib
+import threading
 import copy
+import collections
 import datetime
+import warnings
 import dateutil.parser
 import numpy
 import pandas
-from karta import Point, geojson
+from scipy.io import netcdf_file
 from . import units
+from . import storage as _storage
+from .proptable import PropertyTable
 
-def castasdict(cast):
-    scalars = [key for key in cast.properties]
-    vectors = list(cast.data.keys())
-    dscalar, dvector = {}, {}
-    for key in scalars:
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _loads(s):
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except ValueError:
+            # orjson rejects the NaN literals written by the json module
+            pass
+    try:
+        return json.loads(s)
+    except TypeError:
+        # Python < 3.6 requires text
+        return json.loads(s.decode("utf-8"))
+
+# Function used to parse JSON documents from bytes. It may be replaced by a
+# faster parser, which should raise ValueError on invalid input. By default
+# orjson is used if it is installed.
+JSON_DECODER = _loads
+
+def loads(s):
+    """ Parse a JSON document from bytes using `JSON_DECODER`. """
+    return JSON_DECODER(s)
+
+# file extensions of narwhal formats
+EXTENSIONS = (".nwl", ".nwz", ".nwb", ".nwd", ".nwx")
+
+def _scalarsasdict(cast):
+    dscalar = {}
+    for key in cast.properties:
         if isinstance(cast.properties[key], datetime.datetime):
             dscalar[key] = cast.properties[key].isoformat(sep=" ")
         else:
             dscalar[key] = cast.properties[key]
+    return dscalar
+
+def castasdict(cast, storage=None):
+    """ Return a JSON-serializable dict representing `cast`. Fields with a
+    policy in the dict `storage`, and float32 fields, are encoded (see
+    `narwhal.storage`). """
+    vectors = list(cast.data.keys())
+    dscalar, dvector = _scalarsasdict(cast), {}
     for key in vectors:
-        if isinstance(cast[key], numpy.ndarray):
+        values = numpy.asarray(cast[key])
+        policy = _storage.getpolicy(storage, key, values)
+        encoded = None
+        if policy is not None and values.dtype.kind in "biuf":
+            encoded = _storage.encodejson(policy, values)
+        if encoded is not None:
+            dvector[key] = encoded
+        elif isinstance(cast[key], numpy.ndarray):
             dvector[key] = cast[key].tolist()
         elif isinstance(cast[key], pandas.Series):
             dvector[key] = cast[key].values.tolist()
@@ -45,17 +98,31 @@ def dictascast(d, obj):
     coords = d_["scalars"].pop("coordinates")
     zunits = findunit(d_.pop("zunits", "meter"))
     zname = d_.pop("zname", "z")
-    z = d_["vectors"].pop(zname)
+    vectors = dict((k, _storage.decodejson(v) if _storage.isencoded(v) else v)
+                   for (k, v) in d_["vectors"].items())
+    z = vectors.pop(zname)
     prop = d["scalars"]
+    _parsedates(prop)
+    prop.update(vectors)
+    cast = obj(z, coords=coords, zunits=zunits, zname=zname, **prop)
+    return cast
+
+def _parsedates(prop):
+    """ Convert date strings in a dict of serialized properties in place. """
     for (key, value) in prop.items():
         if "date" in key or "time" in key and isinstance(prop[key], str):
             try:
                 prop[key] = dateutil.parser.parse(value)
             except (TypeError, ValueError):
                 pass
-    prop.update(d_["vectors"])
-    cast = obj(z, coords=coords, zunits=zunits, zname=zname, **prop)
-    return cast
+    return prop
+
+def castproperties(d):
+    """ Return the properties of the serialized cast `d` as the corresponding
+    Cast would hold them, without reading its vector data. """
+    prop = dict(d["scalars"])
+    prop["coordinates"] = tuple(prop.get("coordinates", d.get("coords")))
+    return _parsedates(prop)
 
 def dictascastcollection(d, castobj):
     """ Read a file-like stream and return a list of Cast-like objects.
@@ -63,32 +130,880 @@ def dictascastcollection(d, castobj):
     casts = [dictascast(cast, castobj) for cast in d["casts"]]
     return casts
 
-def writecast(f, cast, binary=True):
+def _dumps(d, compact=False):
+    if compact:
+        return json.dumps(d, separators=(",", ":"))
+    return json.dumps(d, indent=2)
+
+def writecast(f, cast, binary=True, compact=False, storage=None):
     """ Write Cast data to a file-like stream. """
-    d = castasdict(cast)
+    s = _dumps(castasdict(cast, storage), compact=compact)
     if binary:
-        s = json.dumps(d, indent=2)
-        # f.write(bytes(s, "utf-8"))
         f.write(six.b(s))
     else:
-        json.dump(d, f, indent=2)
+        f.write(s)
     return
 
-def writecastcollection(f, cc, binary=True):
-    """ Write CastCollection to a file-like stream. """
-    casts = [castasdict(cast) for cast in cc]
-    d = dict(type="castcollection", casts=casts)
-    if binary:
-        s = json.dumps(d, indent=2)
-        # f.write(bytes(s, "utf-8"))
-        f.write(six.b(s))
+def writecastcollection(f, cc, binary=True, compact=False, storage=None):
+    """ Write CastCollection to a file-like stream.
+
+    Casts are serialized and written one at a time, so that memory use is
+    bounded by the size of the largest cast. The default output is indented
+    JSON; with `compact::bool` whitespace is omitted. Fields are encoded
+    according to the storage policies in the dict `storage`.
+    """
+    write = (lambda s: f.write(six.b(s))) if binary else f.write
+    if compact:
+        head, sep, tail, indent = '{"type":"castcollection","casts":[', ",", "]}", ""
+    else:
+        head = '{\n  "type": "castcollection",\n  "casts": [\n    '
+        sep, tail, indent = ",\n    ", "\n  ]\n}", "\n    "
+
+    first = True
+    for cast in cc:
+        s = _dumps(castasdict(cast, storage), compact=compact)
+        if not compact:
+            s = s.replace("\n", indent)
+        write((head if first else sep) + s)
+        first = False
+
+    if first:   # empty collection
+        write('{"type":"castcollection","casts":[]}' if compact else
+              '{\n  "type": "castcollection",\n  "casts": []\n}')
     else:
-        json.dump(d, f, indent=2)
+        write(tail)
+    return
+
+def writecastlines(f, casts, binary=True, storage=None):
+    """ Write casts to a stream in the newline-delimited (.nwd) format, in
+    which each line holds one cast as compact JSON. Each cast is written with
+    a single call, so that appending processes do not interleave lines. """
+    for cast in casts:
+        s = _dumps(castasdict(cast, storage), compact=True) + "\n"
+        f.write(six.b(s) if binary else s)
+    return
+
+def appendcastlines(fnm, casts, storage=None):
+    """ Append casts to the newline-delimited file at `fnm::string`, creating
+    it if necessary. An incomplete final line, as left by an interrupted
+    append, is removed first, so that the appended lines remain readable. """
+    with open(fnm, "a+b") as f:
+        _truncatepartialline(f)
+        writecastlines(f, casts, storage=storage)
+    return
+
+def _truncatepartialline(f, blocksize=65536):
+    """ Truncate a binary stream after its last newline. """
+    f.seek(0, 2)
+    end = f.tell()
+    pos = end
+    while pos > 0:
+        n = min(blocksize, pos)
+        pos -= n
+        f.seek(pos)
+        i = f.read(n).rfind(b"\n")
+        if i != -1:
+            if pos + i + 1 != end:
+                f.truncate(pos + i + 1)
+            return
+    if end != 0:
+        f.truncate(0)
     return
 
-def castcollection_as_geojson(cc):
-    castpoints = (Point(c.coords, properties={"id":i})
-                  for i, c in enumerate(cc))
-    geojsonstring = geojson.printFeatureCollection(castpoints)
-    return geojsonstring
+def itercastlines(f, start=0, end=None):
+    """ Generate `(offset, nbytes, castdict)` for each line of a binary
+    newline-delimited stream that begins within the byte range [start, end).
+
+    Ranges that split the stream at arbitrary bytes partition its lines, so
+    that ranges can be parsed independently. An incomplete final line, as left
+    by an interrupted append, is ignored.
+    """
+    if start > 0:
+        f.seek(start - 1)
+        f.readline()
+    else:
+        f.seek(0)
+    offset = f.tell()
+    while end is None or offset < end:
+        line = f.readline()
+        if not line:
+            break
+        if line.strip():
+            try:
+                d = loads(line)
+            except ValueError:
+                if line.endswith(b"\n"):
+                    raise
+                break
+            yield offset, len(line), d
+        offset += len(line)
+
+def linesplits(fnm, n):
+    """ Split the file `fnm` into `n::int` byte ranges for `itercastlines`. """
+    size = os.path.getsize(fnm)
+    bounds = [size*i // n for i in range(n+1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# Blocked gzip (.nwx) format
+#
+# Casts are written as newline-delimited JSON lines, grouped into blocks of
+# roughly `blocksize` bytes that are compressed as independent gzip members.
+# The blocks are followed by a gzip member holding a JSON index, which
+# records the location of each block and, for each cast, its block, position
+# and length within the decompressed block, coordinates, and scalar
+# properties. The file ends with an empty gzip member whose extra field ("NW")
+# holds the offset and length of the index, so that the whole file remains a
+# valid multi-member gzip stream.
+
+_NWX_FOOTER_SIZE = 42
+_NWX_EXTRA_ID = b"NW"
+
+def _gzipmember(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def _nwxfooter(offset, nbytes):
+    payload = struct.pack("<QQ", offset, nbytes)
+    extra = _NWX_EXTRA_ID + struct.pack("<H", len(payload)) + payload
+    header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff" + \
+             struct.pack("<H", len(extra)) + extra
+    # empty deflate stream, CRC32 and size
+    return header + b"\x03\x00" + b"\x00" * 8
+
+def _readnwxfooter(footer):
+    """ Return the (offset, nbytes) of the index from a .nwx footer, or None if
+    `footer` is not one. """
+    if len(footer) != _NWX_FOOTER_SIZE or \
+            footer[:4] != b"\x1f\x8b\x08\x04" or footer[12:14] != _NWX_EXTRA_ID:
+        return None
+    return struct.unpack("<QQ", footer[16:32])
+
+def writeblocked(f, casts, blocksize=1<<16, storage=None):
+    """ Write casts to a binary stream in the blocked gzip (.nwx) format. Casts
+    are serialized one at a time, and blocks are compressed independently so
+    that individual casts can be read without decompressing the whole file. """
+    blocks, entries = [], []
+    pending, pendingsize, position = [], 0, 0
+    for cast in casts:
+        d = castasdict(cast, storage)
+        line = six.b(_dumps(d, compact=True) + "\n")
+        if pendingsize != 0 and pendingsize + len(line) > blocksize:
+            position += _writeblock(f, pending, position, blocks)
+            pending, pendingsize = [], 0
+        entries.append(dict(block=len(blocks), offset=pendingsize,
+                            nbytes=len(line), coords=d["coords"],
+                            scalars=d["scalars"]))
+        pending.append(line)
+        pendingsize += len(line)
+    if pendingsize != 0:
+        position += _writeblock(f, pending, position, blocks)
+
+    index = _gzipmember(six.b(_dumps(dict(type="castcollection", version=1,
+                                          blocks=blocks, casts=entries),
+                                     compact=True)))
+    f.write(index)
+    f.write(_nwxfooter(position, len(index)))
+    return
+
+def _writeblock(f, lines, position, blocks):
+    member = _gzipmember(b"".join(lines))
+    f.write(member)
+    blocks.append([position, len(member)])
+    return len(member)
+
+def sniff(f, fnm=None):
+    """ Identify the format of a file open for binary reading as `f` from its
+    leading bytes (and for blocked files, its footer). Returns one of "nwb",
+    "nwx", "gzip", "netcdf", "hdf5", "ndjson", or "json". "netcdf" refers to
+    the NetCDF3 formats; NetCDF4 files are identified as "hdf5", which can
+    not be read. Newline-delimited files are identified by the ".nwd"
+    extension of `fnm::string`. The stream is returned to its start.
+    """
+    head = f.read(len(NWB_MAGIC))
+    if head == NWB_MAGIC:
+        fmt = "nwb"
+    elif head[:2] == b"\x1f\x8b":
+        fmt = "gzip"
+        f.seek(0, 2)
+        if f.tell() >= _NWX_FOOTER_SIZE:
+            f.seek(-_NWX_FOOTER_SIZE, 2)
+            if _readnwxfooter(f.read(_NWX_FOOTER_SIZE)) is not None:
+                fmt = "nwx"
+    elif head[:3] == b"CDF":
+        fmt = "netcdf"
+    elif head[:4] == b"\x89HDF":
+        fmt = "hdf5"
+    elif fnm is not None and os.path.splitext(fnm)[1] == ".nwd":
+        fmt = "ndjson"
+    else:
+        fmt = "json"
+    f.seek(0)
+    return fmt
+
+def isblocked(fnm):
+    """ Return whether `fnm` is a file in the blocked gzip (.nwx) format. """
+    with open(fnm, "rb") as f:
+        f.seek(0, 2)
+        if f.tell() < _NWX_FOOTER_SIZE:
+            return False
+        f.seek(-_NWX_FOOTER_SIZE, 2)
+        return _readnwxfooter(f.read(_NWX_FOOTER_SIZE)) is not None
+
+class BlockedReader(object):
+    """ Random access to the casts in a blocked gzip (.nwx) file. Properties
+    are available from the index without decompressing any block, and reading
+    a cast decompresses only the block that holds it. """
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        self._f = open(fnm, "rb")
+        self._lock = threading.Lock()
+        self._f.seek(-_NWX_FOOTER_SIZE, 2)
+        loc = _readnwxfooter(self._f.read(_NWX_FOOTER_SIZE))
+        if loc is None:
+            self._f.close()
+            raise IOError("{0} is not a blocked narwhal file".format(fnm))
+        self._f.seek(loc[0])
+        index = loads(zlib.decompress(self._f.read(loc[1]), 31))
+        self._blocks = index["blocks"]
+        self._casts = index["casts"]
+        self._cached = (None, None)
+        return
+
+    def __len__(self):
+        return len(self._casts)
+
+    def properties(self, i):
+        """ Return the properties of cast `i::int`. """
+        return castproperties(self._casts[i])
+
+    def _block(self, b):
+        with self._lock:
+            if self._cached[0] != b:
+                offset, nbytes = self._blocks[b]
+                self._f.seek(offset)
+                self._cached = (b, zlib.decompress(self._f.read(nbytes), 31))
+            return self._cached[1]
+
+    def castdict(self, i):
+        """ Return the serialized dict of cast `i::int`. """
+        entry = self._casts[i]
+        block = self._block(entry["block"])
+        line = block[entry["offset"]:entry["offset"]+entry["nbytes"]]
+        return loads(line)
+
+    def close(self):
+        self._f.close()
+        return
+
+# CF contiguous ragged array NetCDF
+#
+# Casts are written following the CF conventions for discrete sampling
+# geometries ("profile" feature type). Vector fields are concatenated along an
+# "obs" dimension, and the "rowSize" variable holds the number of
+# observations in each profile. Scalar properties are stored along the
+# "profile" dimension, with the cast coordinates as "lon" and "lat" and the
+# "date" property as "time". Variables carry a "narwhal_name" attribute
+# recording the original field or property name.
+
+_CF_UNITS = {units.meter: "m",
+             units.kilometer: "km",
+             units.decibar: "dbar",
+             units.second: "s",
+             units.degree_celsius: "degree_Celsius",
+             units.meter_per_second: "m s-1",
+             units.kilogram_per_cubic_meter: "kg m-3"}
+
+_EPOCH = numpy.datetime64("1970-01-01T00:00:00", "us")
+_TIME_UNITS = "days since 1970-01-01 00:00:00"
+
+def _attrstr(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+def _chararray(strings):
+    encoded = [b"" if v is None else v.encode("utf-8") for v in strings]
+    width = max([1] + [len(v) for v in encoded])
+    return numpy.array(encoded, dtype="S{0}".format(width)).view("S1")\
+                .reshape(len(encoded), width)
+
+def writeragged(fnm, casts):
+    """ Write casts to a NetCDF file as CF profiles in a contiguous ragged
+    array. All casts must share the same vertical coordinate.
+
+    Numerical fields are stored as float64, with NaN where a cast lacks a
+    field. Numerical, datetime, and string properties are stored; other
+    properties and non-numerical fields are omitted with a warning.
+    """
+    casts = list(casts)
+    if len(set((c.zname, str(c.zunits)) for c in casts)) > 1:
+        raise ValueError("casts must share a vertical coordinate to be "
+                         "written as a ragged array")
+    zname = casts[0].zname if casts else "z"
+    zunits = str(casts[0].zunits) if casts else units.meter
+
+    counts = numpy.array([len(c.data) for c in casts], dtype=numpy.int32)
+    offsets = numpy.concatenate([[0], numpy.cumsum(counts, dtype=numpy.int64)])
+    fields = [zname]
+    for cast in casts:
+        for key in cast.fields:
+            if key not in fields:
+                if cast.data[key].dtype.kind in "biuf":
+                    fields.append(key)
+                else:
+                    warnings.warn("non-numerical field '{0}' is not "
+                                  "written".format(key))
+    table = PropertyTable.fromproperties(c.properties for c in casts)
+
+    nc = netcdf_file(fnm, "w", version=2)
+    try:
+        nc.Conventions = "CF-1.6"
+        nc.featureType = "profile"
+        nc.createDimension("profile", len(casts))
+        nc.createDimension("obs", int(offsets[-1]))
+
+        var = nc.createVariable("rowSize", "i4", ("profile",))
+        var[:] = counts
+        var.long_name = "number of observations for this profile"
+        var.sample_dimension = "obs"
+
+        # variables named by the CF conventions are reserved, and fields and
+        # properties with those names are renamed (see `_uniquename`)
+        names = set(_RAGGED_RESERVED)
+        for key in fields:
+            data = numpy.full(offsets[-1], numpy.nan)
+            for i, cast in enumerate(casts):
+                if key in cast.data:
+                    data[offsets[i]:offsets[i+1]] = cast.data[key].values
+            var = nc.createVariable(_uniquename(key, names, "field_"), "f8",
+                                    ("obs",))
+            var[:] = data
+            var.narwhal_name = key
+            if key == zname:
+                var.axis = "Z"
+                var.positive = "down"
+                var.units = _CF_UNITS.get(zunits, zunits)
+                var.narwhal_units = zunits
+
+        for key in table.keys():
+            col = table[key]
+            if key == "lon" or key == "lat":
+                name = key
+            elif key == "date" and col.dtype.kind == "M":
+                name = "time"
+            else:
+                name = _uniquename(key, names, "property_")
+
+            if col.dtype.kind == "f":
+                var = nc.createVariable(name, "f8", ("profile",))
+                var[:] = col
+            elif col.dtype.kind == "M":
+                var = nc.createVariable(name, "f8", ("profile",))
+                var[:] = (col - _EPOCH) / numpy.timedelta64(1, "D")
+                var.units = _TIME_UNITS
+                var.calendar = "standard"
+            elif all(v is None or isinstance(v, six.string_types) for v in col):
+                chars = _chararray(col)
+                nc.createDimension(name + "_strlen", chars.shape[1])
+                var = nc.createVariable(name, "c", ("profile", name + "_strlen"))
+                var[:] = chars
+            else:
+                warnings.warn("property '{0}' is not written".format(key))
+                continue
+            var.narwhal_name = key
+
+            if name == "lon":
+                var.standard_name = "longitude"
+                var.units = "degrees_east"
+            elif name == "lat":
+                var.standard_name = "latitude"
+                var.units = "degrees_north"
+            elif name == "time":
+                var.standard_name = "time"
+    finally:
+        nc.close()
+    return
+
+# variable names used by `writeragged` for the CF ragged array index,
+# coordinates, and time
+_RAGGED_RESERVED = ("rowSize", "lon", "lat", "time")
+
+def _uniquename(key, names, prefix):
+    """ Return a NetCDF variable name for `key` that is not in the set `names`,
+    prepending `prefix` as necessary, and add it to `names`. """
+    name = key
+    while name in names:
+        name = prefix + name
+    names.add(name)
+    return name
+
+def opennetcdf(fnm):
+    """ Return a memory-mapped netcdf_file for reading `fnm`, which may be a
+    file name, a file open for binary reading, or an open netcdf_file, which
+    is returned unchanged. A netcdf_file closes the file it was opened from.
+    """
+    if isinstance(fnm, netcdf_file):
+        return fnm
+    return netcdf_file(fnm, "r", mmap=True)
+
+def isragged(fnm):
+    """ Return whether `fnm` is a NetCDF file of CF profiles in a contiguous
+    ragged array. `fnm` may be a file name or an open netcdf_file, which is
+    left open. """
+    nc = opennetcdf(fnm)
+    try:
+        return _attrstr(getattr(nc, "featureType", "")) == "profile" and \
+                "rowSize" in nc.variables
+    finally:
+        if nc is not fnm:
+            nc.close()
+
+class RaggedReader(object):
+    """ Random access to the casts in a CF contiguous ragged array NetCDF file,
+    as written by `writeragged`. The file is memory-mapped, and reading a cast
+    copies only its rows of each variable. `fnm` may be a file name or an open
+    netcdf_file, which is closed with the reader. """
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        self._nc = opennetcdf(fnm)
+        variables = self._nc.variables
+        counts = variables["rowSize"].data.astype(numpy.int64)
+        self._offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+
+        self._fields = []
+        self.zname, self.zunits = "z", units.meter
+        columns = []
+        for name, var in variables.items():
+            key = _attrstr(getattr(var, "narwhal_name", name))
+            if var.dimensions == ("obs",):
+                self._fields.append((key, name))
+                if _attrstr(getattr(var, "axis", "")) == "Z":
+                    self.zname = key
+                    self.zunits = findunit(_attrstr(getattr(var, "narwhal_units",
+                                                            units.meter)))
+            elif var.dimensions[:1] == ("profile",) and name != "rowSize":
+                columns.append((key, self._column(var)))
+
+        self._properties = [{} for _ in counts]
+        lonlat = {}
+        for key, col in columns:
+            if key in ("lon", "lat"):
+                lonlat[key] = col
+                continue
+            for prop, value in zip(self._properties, col):
+                if value is not None:
+                    prop[key] = value
+        for i, prop in enumerate(self._properties):
+            prop["coordinates"] = tuple(lonlat[k][i] if k in lonlat else None
+                                        for k in ("lon", "lat"))
+        return
+
+    @staticmethod
+    def _column(var):
+        """ Convert a profile variable to a list of property values. """
+        if var.typecode() == "c":
+            return [b"".join(row).rstrip(b"\0").decode("utf-8") or None
+                    for row in var.data]
+        values = var.data.astype(numpy.float64)
+        if _attrstr(getattr(var, "units", "")) == _TIME_UNITS:
+            return [None if numpy.isnan(v) else
+                    (_EPOCH + numpy.timedelta64(int(round(v*86400e6)), "us")).astype(datetime.datetime)
+                    for v in values]
+        return [None if numpy.isnan(v) else float(v) for v in values]
+
+    def __len__(self):
+        return len(self._properties)
+
+    def properties(self, i):
+        """ Return the properties of cast `i::int`. """
+        return self._properties[i]
+
+    def castarrays(self, i):
+        """ Return a list of (field, array) pairs for cast `i::int`. """
+        a, b = self._offsets[i], self._offsets[i+1]
+        variables = self._nc.variables
+        return [(key, variables[name].data[a:b].astype(numpy.float64))
+                for (key, name) in self._fields]
+
+    def close(self):
+        self._nc.close()
+        return
+
+def castcollection_as_geojson(cc, properties=()):
+    """ Return a GeoJSON FeatureCollection string of cast locations. See
+    `writegeojson`. """
+    f = six.StringIO()
+    writegeojson(f, cc, properties=properties, binary=False)
+    return f.getvalue()
+
+def _jsonscalar(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    elif isinstance(value, numpy.generic):
+        value = value.item()
+    if isinstance(value, float) and not numpy.isfinite(value):
+        return None
+    return value
+
+def caststats(cast):
+    """ Return the maximum of the vertical coordinate and the number of valid
+    levels of `cast`, where a level is valid if the vertical coordinate and at
+    least one other numerical field are not NaN. """
+    z = numpy.asarray(cast.data[cast.zname].values, dtype=numpy.float64)
+    valid = ~numpy.isnan(z)
+    others = [cast.data[k].values for k in cast.fields
+              if k != cast.zname and cast.data[k].dtype.kind in "biuf"]
+    if others:
+        anyvalid = numpy.zeros(len(z), dtype=bool)
+        for values in others:
+            anyvalid |= ~numpy.isnan(values)
+        valid &= anyvalid
+    nvalid = int(valid.sum())
+    zmax = float(z[valid].max()) if nvalid != 0 else None
+    return zmax, nvalid
+
+def _geojsonfeature(i, cast, properties):
+    prop = {"id": i}
+    for key in properties:
+        if key in cast.properties:
+            prop[key] = _jsonscalar(cast.properties[key])
+    prop["max_depth"], prop["nvalid"] = caststats(cast)
+    lon, lat = cast.coords
+    if lon is None or lat is None:
+        geometry = None
+    else:
+        geometry = {"type": "Point", "coordinates": [float(lon), float(lat)]}
+    return json.dumps({"type": "Feature", "geometry": geometry,
+                       "properties": prop}, separators=(",", ":"))
+
+def writegeojson(f, casts, properties=(), binary=True, chunksize=1000):
+    """ Write the locations of casts to a stream as a GeoJSON
+    FeatureCollection of Points.
+
+    Each feature carries the cast's position in `casts` as "id", the scalar
+    properties named in `properties::iterable`, the maximum of the vertical
+    coordinate as "max_depth", and the number of valid levels as "nvalid"
+    (see `caststats`). Features are written in chunks of `chunksize::int`, so
+    that memory use does not depend on the number of casts when `casts` is an
+    iterator (e.g. from `narwhal.iterread`) or a LazyCastCollection.
+    """
+    write = (lambda s: f.write(six.b(s))) if binary else f.write
+    properties = list(properties)
+    write('{"type":"FeatureCollection","features":[')
+    chunk = []
+    first = True
+    for i, cast in enumerate(casts):
+        chunk.append(_geojsonfeature(i, cast, properties))
+        if len(chunk) == chunksize:
+            write(("" if first else ",") + ",\n".join(chunk))
+            chunk, first = [], False
+    if chunk:
+        write(("" if first else ",") + ",\n".join(chunk))
+    write("]}\n")
+    return
+
+
+def openjson(fnm):
+    """ Open a serialized narwhal file for binary reading, transparently
+    decompressing gzipped (.nwz) files. """
+    f = open(fnm, "rb")
+    if f.read(2) == b"\x1f\x8b":
+        f.close()
+        return gzip.open(fnm, "rb")
+    f.seek(0)
+    return f
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_NONASCII = re.compile(r"[\x80-\xff]")
+
+class _JSONScanner(object):
+    """ Reads JSON values one at a time from a binary stream, tracking byte
+    offsets. The stream is decoded as latin-1 so that character positions
+    coincide with byte positions; values containing non-ASCII characters are
+    re-decoded as UTF-8. """
+
+    def __init__(self, f, chunksize):
+        self.f = f
+        self.chunksize = chunksize
+        self.buf = ""
+        self.pos = 0
+        self.base = 0
+        self.decoder = json.JSONDecoder()
+        return
+
+    @property
+    def offset(self):
+        return self.base + self.pos
+
+    def _fill(self, minsize=0):
+        chunk = self.f.read(max(self.chunksize, minsize))
+        if not chunk:
+            return False
+        self.base += self.pos
+        self.buf = self.buf[self.pos:] + chunk.decode("latin-1")
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Skip whitespace and return the next character, or None at the end
+        of the stream. """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def expect(self, chars):
+        c = self.peek()
+        if c is None or c not in chars:
+            raise ValueError("expected {0} at byte {1}".format(
+                             " or ".join(repr(ch) for ch in chars), self.offset))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """ Decode the next JSON value, returning (value, start, end). """
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or not self._fill():
+                    break
+            except ValueError:
+                # value may be incomplete; grow the buffer geometrically
+                if not self._fill(len(self.buf) - self.pos):
+                    raise
+        if _NONASCII.search(self.buf, self.pos, end):
+            obj = json.loads(self.buf[self.pos:end].encode("latin-1").decode("utf-8"))
+        start = self.offset
+        self.pos = end
+        return obj, start, self.offset
+
+def scancasts(f, chunksize=1<<20):
+    """ Incrementally parse a serialized Cast or CastCollection from the binary
+    stream `f`, yielding `(offset, nbytes, castdict)` for each cast.
+
+    Only one cast is held in memory at a time. Offsets count bytes from the
+    start of the (decompressed) stream, so that a cast can later be re-read
+    with `f.seek(offset)` and `f.read(nbytes)`.
+    """
+    scanner = _JSONScanner(f, chunksize)
+    scanner.peek()
+    start = scanner.offset
+    scanner.expect("{")
+    members = {}
+    while scanner.peek() != "}":
+        key, _, _ = scanner.value()
+        scanner.expect(":")
+        if key == "casts":
+            scanner.expect("[")
+            if scanner.peek() == "]":
+                scanner.expect("]")
+            else:
+                while True:
+                    d, a, b = scanner.value()
+                    yield a, b-a, d
+                    if scanner.expect(",]") == "]":
+                        break
+        else:
+            members[key], _, _ = scanner.value()
+        if scanner.expect(",}") == "}":
+            break
+    else:
+        scanner.expect("}")
+
+    typ = members.get("type", None)
+    if typ is None:
+        raise AttributeError("couldn't read data type - file may be corrupt")
+    elif typ != "castcollection":
+        yield start, scanner.offset-start, members
+
+# Binary (.nwb) format
+#
+# An 8-byte magic number, the length of a JSON header as a little-endian
+# uint64, the UTF-8 encoded header, and a data section aligned to 64 bytes.
+# The header describes each cast by its scalar properties, units, and vector
+# fields. Fields with numerical dtypes are grouped by dtype into blocks of
+# shape (nfields, nlevels), stored as raw little-endian arrays at a recorded
+# offset into the data section. Other fields are stored in the header.
+#
+# Fields encoded by a storage policy (version 2) are listed with their
+# parameters under "storage" in the cast header. Quantized fields are stored
+# as integer codes in blocks marked "encoded", and regular grids are stored in
+# the header only.
+
+NWB_MAGIC = b"\x89NWB\r\n\x1a\n"
+NWB_VERSION = 2
+_ALIGN = 64
+
+def _align(n, alignment=_ALIGN):
+    return -(-n // alignment) * alignment
+
+def _castblocks(cast, storage=None):
+    """ Group the numerical fields of a cast by little-endian dtype, returning
+    a list of (dtype, encoded, fields, arrays), a dict of other fields, and a
+    dict of storage parameters of encoded fields. """
+    groups = collections.OrderedDict()
+    other, params = {}, {}
+    for key in cast.fields:
+        values = cast.data[key].values
+        policy = _storage.getpolicy(storage, key, values)
+        result = None
+        if policy is not None and values.dtype.kind in "biuf":
+            result = policy.encode(values)
+        if result is not None:
+            params[key] = dict(result[0], storage=policy.name)
+            values = result[1]
+            if values is None:
+                continue
+            encoded = policy.name != "float32"
+        else:
+            encoded = False
+        if values.dtype.kind in "biufcmM":
+            dtype = values.dtype.newbyteorder("<")
+            group = groups.setdefault((dtype.str, encoded), ([], []))
+            group[0].append(key)
+            group[1].append(values)
+        else:
+            other[key] = list(values)
+    blocks = [(dtype, encoded, fields, arrays) for ((dtype, encoded), (fields, arrays))
+              in groups.items()]
+    return blocks, other, params
+
+def writebinary(f, obj, storage=None):
+    """ Write a Cast or CastCollection to a binary stream in the .nwb format.
+    Casts are written one at a time. Fields are encoded according to the
+    storage policies in the dict `storage`. """
+    casts = [obj] if obj._type == "cast" else list(obj)
+    headers = []
+    offset = 0
+    for cast in casts:
+        blocks, other, params = _castblocks(cast, storage)
+        n = len(cast.data)
+        hblocks = []
+        for dtype, encoded, fields, _ in blocks:
+            hblocks.append(dict(dtype=dtype, fields=fields, offset=offset,
+                                shape=[len(fields), n]))
+            if encoded:
+                hblocks[-1]["encoded"] = True
+            offset = _align(offset + len(fields)*n*numpy.dtype(dtype).itemsize)
+        h = dict(type=cast._type, scalars=_scalarsasdict(cast),
+                 coords=cast.coords, zunits=str(cast.zunits),
+                 zname=str(cast.zname), fields=list(cast.fields),
+                 blocks=hblocks, vectors=other)
+        if params:
+            h["storage"] = params
+        headers.append(h)
+    header = json.dumps(dict(type=obj._type, version=NWB_VERSION,
+                             casts=headers)).encode("utf-8")
+
+    start = _align(len(NWB_MAGIC) + 8 + len(header))
+    f.write(NWB_MAGIC)
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
+    f.write(b"\0" * (start - len(NWB_MAGIC) - 8 - len(header)))
+
+    position = 0
+    for cast, h in zip(casts, headers):
+        blocks = _castblocks(cast, storage)[0]
+        for block, (_, _, _, arrays) in zip(h["blocks"], blocks):
+            f.write(b"\0" * (block["offset"] - position))
+            arr = numpy.empty(block["shape"], dtype=block["dtype"])
+            for i, values in enumerate(arrays):
+                arr[i] = values
+            f.write(arr.tobytes())
+            position = block["offset"] + arr.nbytes
+    return
+
+def isbinary(fnm):
+    """ Return whether `fnm` is a file in the .nwb format. """
+    with open(fnm, "rb") as f:
+        return f.read(len(NWB_MAGIC)) == NWB_MAGIC
+
+def readbinaryheader(fnm):
+    """ Read the header of a .nwb file at `fnm::string` or open for binary
+    reading, returning the header dict and the byte offset of the data
+    section. """
+    if hasattr(fnm, "read"):
+        f = fnm
+        fnm = getattr(f, "name", "stream")
+        f.seek(0)
+        header, nbytes = _readbinaryheader(f, fnm)
+    else:
+        with open(fnm, "rb") as f:
+            header, nbytes = _readbinaryheader(f, fnm)
+    if header.get("version", 0) > NWB_VERSION:
+        raise IOError("{0} was written by a newer version of narwhal".format(fnm))
+    return header, _align(len(NWB_MAGIC) + 8 + nbytes)
+
+def _readbinaryheader(f, fnm):
+    if f.read(len(NWB_MAGIC)) != NWB_MAGIC:
+        raise IOError("{0} is not a narwhal binary file".format(fnm))
+    nbytes = struct.unpack("<Q", f.read(8))[0]
+    return loads(f.read(nbytes)), nbytes
+
+def mapbinarydata(fnm, start):
+    """ Return the data section of a .nwb file at `fnm::string` or open for
+    binary reading, beginning at byte `start`, as a read-only memory-mapped
+    uint8 array. The mapping remains valid after an open file is closed. """
+    if hasattr(fnm, "read"):
+        fnm.seek(0, 2)
+        size = fnm.tell()
+    else:
+        size = os.path.getsize(fnm)
+    if size <= start:
+        return numpy.empty(0, dtype=numpy.uint8)
+    return numpy.memmap(fnm, dtype=numpy.uint8, mode="r", offset=start)
+
+def framefromblocks(blocks, other, fields):
+    """ Build a DataFrame with columns `fields` from a list of (fields, array)
+    blocks with shape (nfields, nlevels), and a dict of other columns. The
+    largest block is wrapped without copying. """
+    blocks = sorted(blocks, key=lambda b: -len(b[0]))
+    if len(blocks) != 0:
+        data = pandas.DataFrame(blocks[0][1].T, columns=blocks[0][0], copy=False)
+        blocks = blocks[1:]
+    else:
+        data = pandas.DataFrame()
+    columns = dict(other)
+    for names, arr in blocks:
+        columns.update(zip(names, arr))
+    for i, key in enumerate(fields):
+        if key in columns:
+            data.insert(i, key, columns[key])
+    return data
+
+def binaryascast(h, data, factory):
+    """ Construct a cast from its .nwb header `h` and the data section `data`
+    as a uint8 array, using `factory(data, zname, zunits, properties)`.
+    Numerical fields are read-only views of `data`, except for fields decoded
+    from a storage policy other than float32. """
+    blocks = []
+    other = dict(h["vectors"])
+    params = h.get("storage", {})
+    for block in h["blocks"]:
+        dtype = numpy.dtype(str(block["dtype"]))
+        k, n = block["shape"]
+        arr = data[block["offset"]:block["offset"]+k*n*dtype.itemsize]
+        arr = arr.view(dtype).reshape(k, n)
+        if block.get("encoded", False):
+            for key, encoded in zip(block["fields"], arr):
+                other[key] = _storage.decodearray(params[key], encoded)
+        else:
+            blocks.append((block["fields"], arr))
+    for key, p in params.items():
+        if key not in other and p["storage"] == "grid":
+            other[key] = _storage.decodearray(p, None)
+    frame = framefromblocks(blocks, other, h["fields"])
+    return factory(frame, str(h["zname"]), findunit(h["zunits"]),
+                   castproperties(h))
 
+def readbinary(fnm, factory):
+    """ Memory-map a .nwb file at `fnm::string` or open for binary reading,
+    and return its type and a list of casts constructed with
+    `factory(data, zname, zunits, properties)`. """
+    header, start = readbinaryheader(fnm)
+    data = mapbinarydata(fnm, start)
+    casts = [binaryascast(h, data, factory) for h in header["casts"]]
+    return header["type"], casts
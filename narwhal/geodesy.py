@@ -0,0 +1,178 @@
+""" Vectorized geodesic distances between geographical coordinates.
+
+Coordinates are given in degrees as (longitude, latitude) arrays, and all
+functions broadcast over their arguments. Distances are in meters.
+"""
+
+import numpy as np
+
+# WGS 84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1.0 / 298.257223563
+
+# Mean Earth radius, for spherical computations
+EARTH_RADIUS = 6371009.0
+
+def haversine(lon0, lat0, lon1, lat1, radius=EARTH_RADIUS):
+    """ Great circle distance on a sphere of `radius::float`. """
+    lon0, lat0, lon1, lat1 = (np.radians(np.asarray(a, dtype=np.float64))
+                              for a in (lon0, lat0, lon1, lat1))
+    h = np.sin(0.5*(lat1-lat0))**2 + \
+        np.cos(lat0) * np.cos(lat1) * np.sin(0.5*(lon1-lon0))**2
+    return 2.0 * radius * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+def vincenty(lon0, lat0, lon1, lat1, a=WGS84_A, f=WGS84_F, tol=1e-12,
+             maxiter=200):
+    """ Geodesic distance on an ellipsoid with semi-major axis `a::float` and
+    flattening `f::float`, using Vincenty's inverse formula.
+
+    The iteration is performed for all pairs at once. Nearly antipodal pairs,
+    for which Vincenty's method fails to converge, fall back to a spherical
+    approximation.
+    """
+    lon0, lat0, lon1, lat1 = np.broadcast_arrays(
+                *(np.radians(np.asarray(v, dtype=np.float64))
+                  for v in (lon0, lat0, lon1, lat1)))
+    b = a * (1.0 - f)
+    L = lon1 - lon0
+    U1 = np.arctan((1.0-f) * np.tan(lat0))
+    U2 = np.arctan((1.0-f) * np.tan(lat1))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    converged = np.zeros(L.shape, dtype=bool)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(maxiter):
+            sinlam, coslam = np.sin(lam), np.cos(lam)
+            sinsig = np.sqrt((cosU2*sinlam)**2 +
+                             (cosU1*sinU2 - sinU1*cosU2*coslam)**2)
+            cossig = sinU1*sinU2 + cosU1*cosU2*coslam
+            sig = np.arctan2(sinsig, cossig)
+            sinalpha = np.where(sinsig == 0.0, 0.0,
+                                cosU1*cosU2*sinlam / sinsig)
+            cos2alpha = 1.0 - sinalpha**2
+            cos2sigm = np.where(cos2alpha == 0.0, 0.0,
+                                cossig - 2.0*sinU1*sinU2 / cos2alpha)
+            C = f / 16.0 * cos2alpha * (4.0 + f*(4.0 - 3.0*cos2alpha))
+            lamprev = lam
+            lam = L + (1.0-C) * f * sinalpha * \
+                    (sig + C*sinsig*(cos2sigm + C*cossig*(-1.0 + 2.0*cos2sigm**2)))
+            converged = np.abs(lam - lamprev) < tol
+            if np.all(converged):
+                break
+
+        u2 = cos2alpha * (a**2 - b**2) / b**2
+        A = 1.0 + u2/16384.0 * (4096.0 + u2*(-768.0 + u2*(320.0 - 175.0*u2)))
+        B = u2/1024.0 * (256.0 + u2*(-128.0 + u2*(74.0 - 47.0*u2)))
+        dsig = B * sinsig * (cos2sigm + 0.25*B*(cossig*(-1.0 + 2.0*cos2sigm**2) -
+                    B/6.0*cos2sigm*(-3.0 + 4.0*sinsig**2)*(-3.0 + 4.0*cos2sigm**2)))
+        s = b * A * (sig - dsig)
+
+    if not np.all(converged):
+        s = np.where(converged, s, haversine(*(np.degrees(v) for v in
+                                               (lon0, lat0, lon1, lat1))))
+    return s
+
+def distance(lon0, lat0, lon1, lat1, method="vincenty"):
+    """ Distance between points, using either the ellipsoidal "vincenty"
+    method (default) or the spherical "haversine" method. """
+    if method == "vincenty":
+        return vincenty(lon0, lat0, lon1, lat1)
+    elif method == "haversine":
+        return haversine(lon0, lat0, lon1, lat1)
+    else:
+        raise ValueError("distance method '{0}' not recognized".format(method))
+
+def cumulative_distance(lons, lats, method="vincenty"):
+    """ Return the cumulative distance along a path of vertices, starting from
+    zero at the first vertex. """
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    cumulative = np.zeros(len(lons), dtype=np.float64)
+    if len(lons) > 1:
+        np.cumsum(distance(lons[:-1], lats[:-1], lons[1:], lats[1:], method=method),
+                  out=cumulative[1:])
+    return cumulative
+
+def iter_distance_matrix(lons0, lats0, lons1=None, lats1=None, chunksize=1024,
+                         method="vincenty"):
+    """ Generate blocks of the pairwise distance matrix between two sets of
+    points, yielding `(rows::slice, block::ndarray)` for `chunksize::int` rows
+    at a time. If the second set of points is omitted, distances are computed
+    within the first set.
+
+    Consuming the blocks one at a time bounds memory for large point sets.
+    """
+    lons0 = np.asarray(lons0, dtype=np.float64)
+    lats0 = np.asarray(lats0, dtype=np.float64)
+    if lons1 is None:
+        lons1, lats1 = lons0, lats0
+    lons1 = np.asarray(lons1, dtype=np.float64)
+    lats1 = np.asarray(lats1, dtype=np.float64)
+    for i in range(0, len(lons0), chunksize):
+        rows = slice(i, min(i+chunksize, len(lons0)))
+        block = distance(lons0[rows, np.newaxis], lats0[rows, np.newaxis],
+                         lons1[np.newaxis, :], lats1[np.newaxis, :],
+                         method=method)
+        yield rows, block
+
+def distance_matrix(lons0, lats0, lons1=None, lats1=None, chunksize=1024,
+                    method="vincenty"):
+    """ Return the pairwise distance matrix between two sets of points,
+    computed in blocks of `chunksize::int` rows. See `iter_distance_matrix`.
+    """
+    n = len(lons0)
+    m = n if lons1 is None else len(lons1)
+    D = np.empty((n, m), dtype=np.float64)
+    for rows, block in iter_distance_matrix(lons0, lats0, lons1, lats1,
+                                            chunksize=chunksize, method=method):
+        D[rows] = block
+    return D
+
+def unitvector(lons, lats):
+    """ Return the unit vectors in Earth-centred Cartesian coordinates of
+    points on a sphere, as an array with a final axis of length 3. """
+    lon = np.radians(np.asarray(lons, dtype=np.float64))
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    coslat = np.cos(lat)
+    return np.stack([coslat*np.cos(lon), coslat*np.sin(lon), np.sin(lat)],
+                    axis=-1)
+
+def _angle(u, v):
+    """ Angle between unit vectors, accurate for small angles. """
+    return np.arctan2(np.linalg.norm(np.cross(u, v), axis=-1),
+                      np.sum(u*v, axis=-1))
+
+def nearest_on_arcs(p, a, b):
+    """ Find the nearest points to unit vectors `p` on the great circle arcs
+    from `a` to `b`, all arrays of shape (n, 3).
+
+    Returns the angular distance from each point to its arc, in radians, and
+    the fraction of the arc length at which the nearest point lies. The
+    nearest point to a degenerate (zero-length) arc is its start.
+    """
+    normal = np.cross(a, b)
+    norm = np.linalg.norm(normal, axis=-1)
+    degenerate = norm < 1e-15
+    normal = normal / np.where(degenerate, 1.0, norm)[:, np.newaxis]
+    theta = _angle(a, b)
+
+    # projection onto the great circle through a and b
+    h = np.sum(normal*p, axis=-1)
+    foot = p - h[:, np.newaxis]*normal
+    footnorm = np.linalg.norm(foot, axis=-1)
+    foot = foot / np.where(footnorm == 0.0, 1.0, footnorm)[:, np.newaxis]
+    inside = (np.sum(np.cross(a, foot)*normal, axis=-1) >= 0.0) & \
+             (np.sum(np.cross(foot, b)*normal, axis=-1) >= 0.0) & \
+             (footnorm != 0.0) & ~degenerate
+
+    da = _angle(p, a)
+    db = _angle(p, b)
+    atstart = degenerate | (da <= db)
+    distance = np.where(inside, np.arcsin(np.clip(np.abs(h), 0.0, 1.0)),
+                        np.where(atstart, da, db))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fraction = np.where(inside, _angle(a, foot) / theta,
+                            np.where(atstart, 0.0, 1.0))
+    return distance, fraction
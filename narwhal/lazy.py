@@ -0,0 +1,385 @@
+""" File-backed CastCollections that load casts on demand.
+
+A LazyCastCollection reads only an index of cast properties when opened.
+Vector data is read when a cast is accessed, and a bounded number of recently
+used casts is kept in memory, so that archives larger than memory can be
+browsed and filtered by property.
+
+    cc = LazyCastCollection("archive.nwz", cachesize=32)
+    deep = cc.castswhere("depth", lambda d: d > 3000)   # reads no vectors
+    for cast in deep:                                    # loads casts one by one
+        ...
+"""
+
+import os
+import collections
+import threading
+import six
+import numpy as np
+from . import fileio
+from .cast import CastCollection, _fromjson, _castfromframe, _raggedcast
+from .cast import read_woce_netcdf, _decodehdf5
+from .proptable import PropertyTable
+
+class JSONCastReader(object):
+    """ Reads casts from a JSON-formatted (.nwl or .nwz) file by byte
+    offset.
+
+    Readers provide `index()`, returning a list of (key, properties) pairs,
+    and `load(key)`, returning the Cast stored under `key`.
+    """
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        self._f = None
+        self._persistent = False
+        self._lock = threading.Lock()
+        return
+
+    def index(self):
+        f = fileio.openjson(self.fnm)
+        try:
+            index = [((offset, nbytes), fileio.castproperties(d))
+                     for (offset, nbytes, d) in fileio.scancasts(f)]
+        finally:
+            f.close()
+        # seeking backwards in a gzip stream re-reads it from the start, so
+        # keep a handle open for sequential access to multi-cast files
+        self._persistent = len(index) > 1
+        return index
+
+    def load(self, key):
+        offset, nbytes = key
+        with self._lock:
+            if self._f is None:
+                f = fileio.openjson(self.fnm)
+            else:
+                f = self._f
+            try:
+                f.seek(offset)
+                s = f.read(nbytes)
+            finally:
+                if self._persistent:
+                    self._f = f
+                else:
+                    f.close()
+        return _fromjson(fileio.loads(s))
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+        return
+
+class LinesCastReader(JSONCastReader):
+    """ Reads casts from a newline-delimited (.nwd) file by byte offset. """
+
+    def index(self):
+        with open(self.fnm, "rb") as f:
+            return [((offset, nbytes), fileio.castproperties(d))
+                    for (offset, nbytes, d) in fileio.itercastlines(f)]
+
+    def load(self, key):
+        offset, nbytes = key
+        with open(self.fnm, "rb") as f:
+            f.seek(offset)
+            s = f.read(nbytes)
+        return _fromjson(fileio.loads(s))
+
+class BinaryCastReader(object):
+    """ Reads casts from a memory-mapped binary (.nwb) file. """
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        self._data = None
+        return
+
+    def index(self):
+        header, self._start = fileio.readbinaryheader(self.fnm)
+        self._headers = header["casts"]
+        return [(i, fileio.castproperties(h))
+                for (i, h) in enumerate(self._headers)]
+
+    def load(self, key):
+        if self._data is None:
+            self._data = fileio.mapbinarydata(self.fnm, self._start)
+        return fileio.binaryascast(self._headers[key], self._data,
+                                   _castfromframe)
+
+    def close(self):
+        self._data = None
+        return
+
+class BlockedCastReader(object):
+    """ Reads casts from a blocked gzip (.nwx) file, using its index. """
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        self._reader = None
+        return
+
+    def index(self):
+        self._reader = fileio.BlockedReader(self.fnm)
+        return [(i, self._reader.properties(i)) for i in range(len(self._reader))]
+
+    def load(self, key):
+        if self._reader is None:
+            self._reader = fileio.BlockedReader(self.fnm)
+        return _fromjson(self._reader.castdict(key))
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        return
+
+class NetCDFCastReader(object):
+    """ Reads casts from a NetCDF file, which may hold a ragged array of
+    profiles or a single WOCE cast. """
+
+    def __init__(self, fnm):
+        self.fnm = fnm
+        self._reader = None
+        return
+
+    def index(self):
+        with open(self.fnm, "rb") as f:
+            if fileio.sniff(f, self.fnm) == "hdf5":
+                _decodehdf5(self.fnm, f)
+        if fileio.isragged(self.fnm):
+            self._reader = fileio.RaggedReader(self.fnm)
+            return [(i, self._reader.properties(i))
+                    for i in range(len(self._reader))]
+        return [(None, read_woce_netcdf(self.fnm).properties)]
+
+    def load(self, key):
+        if key is None:
+            return read_woce_netcdf(self.fnm)
+        if self._reader is None:
+            self._reader = fileio.RaggedReader(self.fnm)
+        return _raggedcast(self._reader, key)
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        return
+
+# file extensions recognized when indexing a directory, and their readers
+READERS = {".nwl": JSONCastReader,
+           ".nwz": JSONCastReader,
+           ".nwb": BinaryCastReader,
+           ".nwd": LinesCastReader,
+           ".nwx": BlockedCastReader,
+           ".nc": NetCDFCastReader}
+
+def _getreader(fnm):
+    ext = os.path.splitext(fnm)[1]
+    if ext not in READERS and fileio.isbinary(fnm):
+        return BinaryCastReader(fnm)
+    elif ext not in READERS and fileio.isblocked(fnm):
+        return BlockedCastReader(fnm)
+    return READERS.get(ext, JSONCastReader)(fnm)
+
+class _LRUCache(object):
+    """ Mapping that retains the `maxsize::int` most recently used items. """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # incremented whenever casts are handed out, and so may have had their
+        # properties changed, by any collection sharing the cache
+        self.version = 0
+        return
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+        return
+
+class _LazyCasts(collections.Sequence):
+    """ Sequence of casts loaded on demand from the index of a
+    LazyCastCollection. """
+
+    def __init__(self, collection):
+        self._collection = collection
+        return
+
+    def __len__(self):
+        return len(self._collection._index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._collection._load(entry)
+                    for entry in self._collection._index[key]]
+        return self._collection._load(self._collection._index[key])
+
+class LazyCastCollection(CastCollection):
+    """ A CastCollection backed by files, in which casts are read on demand.
+
+    Create from a single file holding a Cast or CastCollection, or from a
+    directory of such files:
+
+        LazyCastCollection("archive.nwz")
+        LazyCastCollection("casts/", cachesize=128)
+
+    Only cast properties and coordinates are kept in memory, and at most
+    `cachesize::int` casts are held at a time. Property queries (`castwhere`,
+    `castswhere` with a property key, `select`, `proptable`, `subset`,
+    `between`), coordinate queries (`coords`, `projdist`, `distance_matrix`,
+    `add_bathymetry`) and slicing use the index and return LazyCastCollections
+    without reading vector data.
+
+    Property changes made to loaded casts are kept in the index, but changes to
+    vector data are discarded when a cast is evicted from the cache.
+    """
+
+    def __init__(self, source, cachesize=64):
+        if os.path.isdir(source):
+            fnms = sorted(os.path.join(source, f) for f in os.listdir(source)
+                          if os.path.splitext(f)[1] in READERS)
+        else:
+            fnms = [source]
+        index = []
+        for fnm in fnms:
+            reader = _getreader(fnm)
+            index.extend((reader, key, prop) for (key, prop) in reader.index())
+        self._init(index, _LRUCache(cachesize))
+        return
+
+    @classmethod
+    def _fromindex(cls, index, cache):
+        cc = cls.__new__(cls)
+        cc._init(index, cache)
+        return cc
+
+    def _init(self, index, cache):
+        super(LazyCastCollection, self).__init__()
+        self._index = index
+        self._cache = cache
+        self.casts = _LazyCasts(self)
+        return
+
+    def _load(self, entry):
+        reader, key, prop = entry
+        self._cache.version += 1
+        cast = self._cache.get((reader, key))
+        if cast is None:
+            cast = reader.load(key)
+            # share property dicts with the index, so that changes survive
+            # eviction from the cache
+            cast.properties = prop
+            cast.p = prop
+            self._cache.put((reader, key), cast)
+        return cast
+
+    def close(self):
+        """ Close open file handles and empty the cast cache. """
+        for reader in set(entry[0] for entry in self._index):
+            reader.close()
+        self._cache.clear()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._fromindex(self._index[key], self._cache)
+        elif isinstance(key, six.string_types) and \
+                all(key in prop for (_, _, prop) in self._index):
+            return [prop[key] for (_, _, prop) in self._index]
+        return super(LazyCastCollection, self).__getitem__(key)
+
+    @property
+    def properties(self):
+        """ List of the property dicts of all casts. """
+        return [prop for (_, _, prop) in self._index]
+
+    @property
+    def proptable(self):
+        """ A PropertyTable of the indexed cast properties. The table is
+        rebuilt after casts have been loaded, since their properties may have
+        been changed. """
+        if self._proptable is None or self._proptable_key != self._cache.version:
+            self._proptable = PropertyTable.fromproperties(self.properties)
+            self._proptable_key = self._cache.version
+        return self._proptable
+
+    def _coordinates(self):
+        return [prop["coordinates"] for (_, _, prop) in self._index]
+
+    def subset(self, selection):
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            if len(selection) != len(self):
+                raise ValueError("boolean mask must have the same length as "
+                                 "the CastCollection")
+            selection = np.flatnonzero(selection)
+        return self._fromindex([self._index[i] for i in selection], self._cache)
+
+    def add_bathymetry(self, bathymetry):
+        lon, lat = self._lonlat()
+        depths = bathymetry.atxy_many(lon, lat)
+        for (_, _, prop), depth in zip(self._index, depths):
+            prop["depth"] = float(depth)
+        self._cache.version += 1
+        return
+
+    def _whereindices(self, key, values):
+        if hasattr(values, "__call__"):
+            return [i for i, (_, _, prop) in enumerate(self._index)
+                    if values(prop[key])]
+        if not isinstance(values, collections.Container) or isinstance(values, six.string_types):
+            values = (values,)
+        return [i for i, (_, _, prop) in enumerate(self._index)
+                if prop.get(key, None) in values]
+
+    def castwhere(self, key, value):
+        for (i, (_, _, prop)) in enumerate(self._index):
+            if prop.get(key, None) == value:
+                return self._load(self._index[i])
+        raise LookupError("Cast not found with {0} = {1}".format(key, value))
+
+    def castswhere(self, key, values=None):
+        if values is None:
+            return super(LazyCastCollection, self).castswhere(key)
+        return self.subset(np.array(self._whereindices(key, values), dtype=int))
+
+    def select(self, key, values):
+        indices = []
+        for v in values:
+            for (i, (_, _, prop)) in enumerate(self._index):
+                if prop.get(key, None) == v:
+                    indices.append(i)
+                    break
+            else:
+                raise LookupError("Cast not found with {0} = {1}".format(key, v))
+        return self.subset(np.array(indices, dtype=int))
+
+    def __repr__(self):
+        return "Lazy" + super(LazyCastCollection, self).__repr__()
@@ -0,0 +1,141 @@
+""" Columnar tables of the scalar properties carried by a collection of casts.
+A PropertyTable makes it possible to filter a CastCollection with array
+operations rather than a Python loop over casts. """
+
+import datetime
+import numbers
+import numpy as np
+import dateutil.tz
+
+_UTC = dateutil.tz.tzutc()
+
+def _isdatetime(value):
+    return isinstance(value, (datetime.datetime, datetime.date, np.datetime64))
+
+def _isnumber(value):
+    return isinstance(value, numbers.Number) and not isinstance(value, complex)
+
+def asdatetime64(value):
+    """ Convert a datetime-like `value` to a numpy datetime64 with microsecond
+    resolution. Timezone-aware datetimes are converted to UTC. """
+    if value is None:
+        return np.datetime64("NaT", "us")
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        value = value.astimezone(_UTC).replace(tzinfo=None)
+    return np.datetime64(value, "us")
+
+def _column(values):
+    """ Convert a list of scalars (None for missing) to an array with the
+    narrowest sensible dtype. """
+    present = [v for v in values if v is not None]
+    if len(present) != 0 and all(_isdatetime(v) for v in present):
+        return np.array([asdatetime64(v) for v in values], dtype="datetime64[us]")
+    elif all(_isnumber(v) for v in present):
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=np.float64)
+    else:
+        col = np.empty(len(values), dtype=object)
+        col[:] = values
+        return col
+
+class PropertyTable(object):
+    """ Column-oriented view of cast properties.
+
+    Each column is a numpy array with one entry per cast. Numerical properties
+    are stored as float64 (missing values are NaN), datetimes as
+    datetime64[us] (missing values are NaT), and everything else in object
+    arrays (missing values are None). Cast coordinates are split into "lon"
+    and "lat" columns.
+
+    Columns support ordinary numpy comparisons, so that boolean masks can be
+    built directly, e.g.
+
+        mask = (table["depth"] > 3000) & (table["lat"] > 60)
+    """
+
+    def __init__(self, columns, n):
+        self.columns = columns
+        self._n = n
+        self._order = {}
+        return
+
+    @classmethod
+    def fromproperties(cls, properties):
+        """ Build a PropertyTable from a sequence of cast property dicts. """
+        properties = list(properties)
+        keys = []
+        for p in properties:
+            for k in p:
+                if k not in keys:
+                    keys.append(k)
+
+        columns = {}
+        for key in keys:
+            if key == "coordinates":
+                coords = [p.get(key, (None, None)) for p in properties]
+                columns["lon"] = _column([c[0] for c in coords])
+                columns["lat"] = _column([c[1] for c in coords])
+            else:
+                columns[key] = _column([p.get(key, None) for p in properties])
+        return cls(columns, len(properties))
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def __getitem__(self, key):
+        try:
+            return self.columns[key]
+        except KeyError:
+            raise KeyError("No property {0}".format(key))
+
+    def keys(self):
+        return list(self.columns.keys())
+
+    def isin(self, key, values):
+        """ Return a boolean mask of casts for which property `key` is in
+        `values::Container`. """
+        col = self[key]
+        if isinstance(values, str) or not hasattr(values, "__iter__"):
+            values = (values,)
+        if col.dtype == object:
+            values = set(values)
+            return np.fromiter((v in values for v in col), dtype=bool,
+                               count=len(col))
+        elif col.dtype.kind == "M":
+            return np.isin(col, [asdatetime64(v) for v in values])
+        else:
+            return np.isin(col, np.asarray(list(values), dtype=col.dtype))
+
+    def _sortorder(self, key):
+        """ Return (cached) sorting indices and sorted values for `key`,
+        excluding missing values. """
+        if key not in self._order:
+            col = self[key]
+            if col.dtype == object:
+                raise TypeError("range queries require a numerical or "
+                                "datetime property")
+            valid = ~np.isnat(col) if col.dtype.kind == "M" else ~np.isnan(col)
+            idx = np.flatnonzero(valid)
+            idx = idx[np.argsort(col[idx], kind="mergesort")]
+            self._order[key] = (idx, col[idx])
+        return self._order[key]
+
+    def between(self, key, lower=None, upper=None):
+        """ Return the sorted indices of casts with `lower <= property < upper`.
+        Either bound may be None. Datetime properties may be bounded by
+        datetimes or ISO 8601 strings.
+
+        The sorting order of each property is computed once and cached, so
+        that repeated range queries cost O(log n).
+        """
+        idx, values = self._sortorder(key)
+        if values.dtype.kind == "M":
+            convert = asdatetime64
+        else:
+            convert = lambda v: v
+        i0 = 0 if lower is None else np.searchsorted(values, convert(lower), side="left")
+        i1 = len(values) if upper is None else np.searchsorted(values, convert(upper), side="left")
+        return np.sort(idx[i0:i1])
@@ -0,0 +1,171 @@
+""" Transport of CastCollection data to worker processes through shared
+memory.
+
+The float64 columns of every cast are copied once into a single shared memory
+block, laid out as one contiguous (nfields, nlevels) array per cast. A small
+picklable descriptor records where each cast lives in the block, together with
+its properties and any columns of other types. Worker processes attach to the
+block and reconstruct read-only Casts whose DataFrames are views of shared
+memory, so that no column data is pickled or copied.
+
+    with SharedCollection(castcollection) as shared:
+        descriptor = shared.descriptor
+        # ... in a worker process:
+        casts = attach(descriptor)
+
+Requires `multiprocessing.shared_memory` (Python 3.8+).
+"""
+
+import pickle
+import numpy as np
+from . import fileio
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# shared memory blocks attached by this process, by name
+_attached = {}
+
+def _require_shared_memory():
+    if shared_memory is None:
+        raise ImportError("shared memory transport requires "
+                          "multiprocessing.shared_memory (Python 3.8+)")
+
+class SharedCollection(object):
+    """ Publishes the columns of a CastCollection to a shared memory block.
+
+    The publishing process owns the block. Closing a SharedCollection (or
+    leaving its context) releases and unlinks the block, after which the
+    descriptor is no longer valid.
+    """
+
+    def __init__(self, castcollection):
+        _require_shared_memory()
+        entries = []
+        offset = 0
+        for cast in castcollection:
+            shared = [k for k in cast.fields if cast.data[k].dtype == np.float64]
+            extra = [(k, cast.data[k].values) for k in cast.fields
+                     if k not in shared]
+            n = len(cast.data)
+            entries.append(dict(zname=cast.zname, zunits=cast.zunits,
+                                properties=cast.properties,
+                                fields=list(cast.fields), shared=shared,
+                                extra=extra, offset=offset, n=n))
+            offset += 8*n*len(shared)
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for cast, entry in zip(castcollection, entries):
+            block = _view(self._shm.buf, entry)
+            for i, k in enumerate(entry["shared"]):
+                block[i] = cast.data[k].values
+            del block
+        self._descriptor = dict(name=self._shm.name, size=self._shm.size,
+                                casts=entries)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return len(self._descriptor["casts"])
+
+    @property
+    def descriptor(self):
+        """ Picklable description of the shared collection, to be passed to
+        `attach` in worker processes. """
+        return self._descriptor
+
+    def close(self):
+        """ Release and unlink the shared memory block. """
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+        return
+
+def _view(buf, entry):
+    """ Return the (nfields, nlevels) array of a cast entry in buffer `buf`. """
+    return np.ndarray((len(entry["shared"]), entry["n"]), dtype=np.float64,
+                      buffer=buf, offset=entry["offset"])
+
+def _openblock(name, size):
+    _require_shared_memory()
+    shm = shared_memory.SharedMemory(name=name)
+    if shm.size < size:
+        shm.close()
+        raise ValueError("shared memory block {0} is smaller than "
+                         "described".format(name))
+    return shm
+
+def _attachblock(name, size):
+    if name not in _attached:
+        _attached[name] = _openblock(name, size)
+    return _attached[name]
+
+def _closeblock(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # views are still referenced, e.g. by a traceback; the mapping is
+        # released when they are collected
+        pass
+    return
+
+def _attachcasts(buf, entries):
+    """ Reconstruct read-only casts from descriptor entries. """
+    from .cast import _castfromframe
+    casts = []
+    for entry in entries:
+        block = _view(buf, entry)
+        block.flags.writeable = False
+        data = fileio.framefromblocks([(entry["shared"], block)],
+                                      dict(entry["extra"]), entry["fields"])
+        casts.append(_castfromframe(data, entry["zname"], entry["zunits"],
+                                    entry["properties"]))
+    return casts
+
+def attach(descriptor):
+    """ Return a CastCollection of read-only casts backed by the shared memory
+    block described by `descriptor`, as returned by
+    `SharedCollection.descriptor`.
+
+    The block stays attached for the lifetime of the process, or until
+    `detach` is called.
+    """
+    from .cast import CastCollection
+    buf = _attachblock(descriptor["name"], descriptor["size"]).buf
+    return CastCollection(_attachcasts(buf, descriptor["casts"]))
+
+def detach(descriptor):
+    """ Detach from a shared memory block. Casts returned by `attach` for this
+    block must no longer be used. """
+    shm = _attached.pop(descriptor["name"], None)
+    if shm is not None:
+        shm.close()
+    return
+
+def _mapshared(func, name, size, entries):
+    """ Worker-side counterpart of CastCollection.map with shared memory.
+
+    The block is attached for the duration of the call only, so that workers
+    of a long-lived executor do not keep blocks mapped after the publishing
+    process unlinks them. Results are returned pickled, because they may be
+    views of the block.
+    """
+    from .cast import _packresults
+    shm = _openblock(name, size)
+    try:
+        results = [func(c) for c in _attachcasts(shm.buf, entries)]
+        packed = [pickle.dumps(r, pickle.HIGHEST_PROTOCOL)
+                  for r in _packresults(results)]
+        del results
+    finally:
+        _closeblock(shm)
+    return packed
@@ -0,0 +1,212 @@
+""" Storage policies controlling the precision with which cast fields are
+held in memory and written to files.
+
+A policy is assigned to fields by name, and may be applied to casts in
+memory or used when writing:
+
+    storage = {"temp": Float32(), "sal": Quantize(0.001), "pres": RegularGrid()}
+    cc.apply_storage(storage)               # convert in memory
+    cc.save("archive.nwz", storage=storage) # encode when writing
+
+Encoded fields are self-describing, so files are read without knowing the
+policies that wrote them. In JSON formats an encoded field is stored as a
+dict with a "storage" key in place of a list of values. In the .nwb format,
+float32 fields are stored as 4-byte blocks, quantized fields as integer
+blocks, and regular grids in the header.
+
+Round-trip guarantees are per policy:
+
+Float32         values are rounded to the nearest float32, and are read back
+                as exactly those float32 values. Float32 fields in memory are
+                written as float32 without an explicit policy.
+Quantize        values are rounded to the nearest multiple of `step`, and are
+                read back as exactly `k*step`, the value held in memory after
+                `apply`. The storage error is at most step/2.
+RegularGrid     fields that are within `tol*step` of the grid
+                start + step*i are stored as (start, step, count) and read back
+                as exactly that grid. Other fields are stored unchanged.
+
+NaN is preserved by all policies.
+"""
+
+import numpy as np
+
+class StoragePolicy(object):
+    """ Base class for storage policies. Subclasses define `apply`, returning
+    the in-memory values, and `encode`/`decode` converting between values
+    and a dict of JSON-serializable parameters and an optional array of
+    encoded values. """
+
+    name = None
+
+    def apply(self, values):
+        return np.asarray(values)
+
+    def encode(self, values):
+        """ Return (params::dict, encoded::ndarray), or None if the policy does
+        not apply to `values`. """
+        raise NotImplementedError()
+
+    @staticmethod
+    def decode(params, encoded):
+        raise NotImplementedError()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        args = ", ".join("{0}={1!r}".format(k, v)
+                         for (k, v) in sorted(self.__dict__.items()))
+        return "{0}({1})".format(type(self).__name__, args)
+
+class Float32(StoragePolicy):
+    """ Store a field as single precision floating point. """
+
+    name = "float32"
+
+    def apply(self, values):
+        return np.asarray(values, dtype=np.float32)
+
+    def encode(self, values):
+        return {}, self.apply(values)
+
+    @staticmethod
+    def decode(params, encoded):
+        return np.asarray(encoded, dtype=np.float32)
+
+class Quantize(StoragePolicy):
+    """ Store a field as integer multiples of `step::float`. """
+
+    name = "quantize"
+
+    def __init__(self, step):
+        if not step > 0:
+            raise ValueError("quantization step must be positive")
+        self.step = float(step)
+        return
+
+    def apply(self, values):
+        return self.decode({"step": self.step}, self.encode(values)[1])
+
+    def encode(self, values):
+        """ Return integer codes, with NaN coded as the minimum integer of
+        the code dtype. """
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        codes = np.round(values[valid] / self.step)
+        largest = np.abs(codes).max() if len(codes) != 0 else 0.0
+        if largest < 2**31 - 1:
+            dtype = np.dtype(np.int32)
+        elif largest < 2.0**63 - 1024:
+            # bounded below the largest float64 that converts to int64
+            dtype = np.dtype(np.int64)
+        else:
+            raise ValueError("values of magnitude {0} cannot be quantized with "
+                             "step {1}".format(largest * self.step, self.step))
+        encoded = np.full(len(values), np.iinfo(dtype).min, dtype=dtype)
+        encoded[valid] = codes
+        return {"step": self.step}, encoded
+
+    @staticmethod
+    def decode(params, encoded):
+        encoded = np.asarray(encoded)
+        if encoded.dtype.kind not in "iu":
+            # JSON lists, with None for NaN
+            encoded = np.array([np.nan if v is None else v for v in encoded],
+                               dtype=np.float64)
+            return encoded * params["step"]
+        values = encoded * params["step"]
+        values[encoded == np.iinfo(encoded.dtype).min] = np.nan
+        return values
+
+class RegularGrid(StoragePolicy):
+    """ Store a regularly spaced field, such as a pressure grid, as its start,
+    step, and count. Fields deviating from a regular grid by more than
+    `tol::float` times the step are stored unchanged. """
+
+    name = "grid"
+
+    def __init__(self, tol=1e-9):
+        self.tol = tol
+        return
+
+    def apply(self, values):
+        encoded = self.encode(values)
+        if encoded is None:
+            return np.asarray(values)
+        return self.decode(encoded[0], None)
+
+    def encode(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if n < 2 or np.any(np.isnan(values)):
+            return None
+        start = float(values[0])
+        step = float(values[-1] - values[0]) / (n - 1)
+        grid = start + step * np.arange(n)
+        if np.any(np.abs(values - grid) > self.tol * abs(step)):
+            return None
+        return {"start": start, "step": step, "count": n}, None
+
+    @staticmethod
+    def decode(params, encoded):
+        return params["start"] + params["step"] * np.arange(params["count"])
+
+POLICIES = {Float32.name: Float32,
+            Quantize.name: Quantize,
+            RegularGrid.name: RegularGrid}
+
+def getpolicy(storage, key, values):
+    """ Return the policy for field `key` from the dict `storage`, defaulting
+    to Float32 for float32 values, or None. """
+    policy = (storage or {}).get(key, None)
+    if policy is None and values.dtype == np.float32:
+        policy = Float32()
+    return policy
+
+def encodejson(policy, values):
+    """ Return the JSON representation of `values` under `policy`, or None if
+    the policy does not apply. """
+    result = policy.encode(values)
+    if result is None:
+        return None
+    params, encoded = result
+    d = dict(params, storage=policy.name)
+    if encoded is None:
+        pass
+    elif policy.name == "float32":
+        # the shortest representation that identifies each float32
+        d["values"] = [float(str(v)) for v in encoded]
+    elif policy.name == "quantize":
+        invalid = np.iinfo(encoded.dtype).min
+        d["values"] = [None if v == invalid else v for v in encoded.tolist()]
+    else:
+        d["values"] = encoded.tolist()
+    return d
+
+def isencoded(value):
+    return isinstance(value, dict) and "storage" in value
+
+def decodejson(d):
+    """ Return the values of a field encoded by `encodejson`. """
+    try:
+        policy = POLICIES[d["storage"]]
+    except KeyError:
+        raise LookupError("unknown storage policy '{0}'".format(d["storage"]))
+    return policy.decode(d, d.get("values", None))
+
+def decodearray(params, encoded):
+    """ Return the values of a field from the .nwb parameters `params` and
+    array `encoded`. """
+    return POLICIES[params["storage"]].decode(params, encoded)
+
+def apply(cast, storage):
+    """ Convert the fields of `cast` in place to their in-memory
+    representations under the policies of the dict `storage`. """
+    for key, policy in storage.items():
+        if key in cast.data:
+            cast.data[key] = policy.apply(cast.data[key].values)
+    return cast
@@ -1,9 +1,7 @@
 # -*- coding: utf-8 -*-
-import numbers
 import numpy as np
-import scipy.integrate as scint
-from scipy.ndimage.morphology import binary_dilation
 from scipy import sparse
+from scipy.sparse.linalg import svds
 
 def sparse_diffmat(n, deriv, h, order=2):
     """ Return an `n::Int` by `n` sparse difference matrix to approximate a
@@ -55,22 +53,58 @@ def diff2(A, x):
     the interior and one-sided differences on the edges. When there are
     interior NaNs, one-sided differences are used to fill in an much data as
     possible. """
-    D2 = np.nan * np.empty_like(A)
-    for (i, arow) in enumerate(A):
-        start = -1
-        for j in range(len(arow)):
+    valid = ~np.isnan(A)
+    hasleft = np.zeros_like(valid)
+    hasright = np.zeros_like(valid)
+    hasleft[:,1:] = valid[:,:-1]
+    hasright[:,:-1] = valid[:,1:]
 
-            if start == -1 and ~np.isnan(arow[j]):
-                start = j
+    D2 = np.nan * np.empty_like(A)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # centred differences where both neighbours exist
+        msk = valid & hasleft & hasright
+        msk_ = msk[:,1:-1]
+        D2[:,1:-1][msk_] = ((A[:,2:] - A[:,:-2]) / (x[2:] - x[:-2]))[msk_]
+
+        # forward differences at the start of each run
+        msk = valid & ~hasleft & hasright
+        msk_ = msk[:,:-1]
+        D2[:,:-1][msk_] = ((A[:,1:] - A[:,:-1]) / (x[1:] - x[:-1]))[msk_]
+
+        # backward differences at the end of each run
+        msk = valid & hasleft & ~hasright
+        msk_ = msk[:,1:]
+        D2[:,1:][msk_] = ((A[:,1:] - A[:,:-1]) / (x[1:] - x[:-1]))[msk_]
+    return D2
 
-            elif start != -1 and np.isnan(arow[j]):
-                if j - start != 1:
-                    D2[i,start:j] = diff1(arow[start:j], x[start:j])
-                start = -1
+def erode_nans(u, du):
+    """ Given a row u containing NaNs and a derivative du, fill the NaNs by
+    accumulating du outward from the neighbouring valid values.
 
-            elif start != -1 and j == len(arow) - 1:
-                D2[i,start:] = diff1(arow[start:], x[start:])
-    return D2
+    Leading NaNs are extended backward from the first valid value, and
+    trailing NaNs forward from the last valid value. Interior gaps are
+    extended forward from the left, except for the last value in each gap,
+    which is the average of the extensions from the left and from the right.
+    """
+    n = len(u)
+    idx = np.arange(n)
+    valid = ~np.isnan(u)
+    left = np.maximum.accumulate(np.where(valid, idx, -1))
+    right = np.minimum.accumulate(np.where(valid, idx, n)[::-1])[::-1]
+    l = np.clip(left, 0, n-1)
+    r = np.clip(right, 0, n-1)
+
+    # C[j] is the accumulated change from u[0] to u[j]
+    C = np.zeros(n, dtype=np.float64)
+    C[1:] = np.cumsum(0.5 * (du[1:] + du[:-1]))
+    fwd = u[l] + (C - C[l])
+    bwd = u[r] - (C[r] - C)
+
+    v = np.where(left == -1, bwd, fwd)
+    gapend = ~valid & (left != -1) & (right == idx+1)
+    v[gapend] = 0.5 * (fwd[gapend] + bwd[gapend])
+    v[valid] = u[valid]
+    return v
 
 def diff2_dinterp(A_, x):
     """ Perform row-wise differences in array A. Handle NaNs by extrapolating
@@ -81,73 +115,38 @@ def diff2_dinterp(A_, x):
     approximation (L-∞), however it has the virtue of allowing centred
     differences everywhere, avoiding non-physical jumps in the resulting field.
     """
-
-    def erode_nans(u, du):
-        """ Given u and a derivative du, extend u whereever a NaN borders a non-NaN """
-        isnan = np.isnan
-        for j in range(len(u)):
-
-            if isnan (u[j]) and j != 0 and j != len(u)-1:
-                if isnan(u[j+1]) and not isnan(u[j-1]):
-                    d = 0.5 * (du[j] + du[j-1])
-                    u[j] = u[j-1] + d
-                elif not isnan(u[j+1]) and isnan(u[j-1]):
-                    d = 0.5 * (du[j] + du[j+1])
-                    u[j] = u[j+1] - d
-                elif not isnan(u[j+1]) and not isnan(u[j-2]):
-                    #u[j] = 0.5 * (u[j-1] + u[j+1])
-                    u[j] = 0.5 * (u[j-1] + 0.5 * (du[j] + du[j-1]) +
-                                  u[j+1] - 0.5 * (du[j] + du[j+1]))
-                else:
-                    pass
-
-            elif j == 0 and isnan(u[j]) and not isnan(u[j+1]):
-                u[j] = u[j+1] - 0.5 * (du[j] + du[j+1])
-
-            elif j == len(u)-1 and isnan(u[j]) and not isnan(u[j-1]):
-                u[j] = u[j-1] + 0.5 * (du[j] + du[j-1])
-
-            else:
-                pass
-
-        return u
-
     A = A_.copy()
-    D2 = np.empty_like(A_)
-    for (i, row) in enumerate(A):
-
-        if np.any(np.isnan(row)):
-
-            if not np.all(np.isnan(row)) and i != 0:
-
-                while np.any(np.isnan(row)):
-                    row = erode_nans(row, D2[i-1,:])
-                A[i,:] = row
-
-            else:
-
-                # Extend upward
-                for j in range(len(row)):
-
-                    if np.isnan(row[j]):
-                        k = 0
-                        while k != A.shape[0]-1:
-                            if not np.isnan(A[k,j]):
-                                A[:k,j] = A[k,j]
-                                break
-                            k += 1
+    nans = np.isnan(A_)
+    (m, n) = A.shape
 
-                        if k == A.shape[0]-1:
-                            raise ValueError("there's a whole column of NaNs")
+    # Extend the first row upward from the first valid value in each column
+    cols = np.flatnonzero(nans[0])
+    if len(cols) != 0:
+        validcols = ~nans[:-1,cols]
+        if not np.all(np.any(validcols, axis=0)):
+            raise ValueError("there's a whole column of NaNs")
+        kfirst = np.argmax(validcols, axis=0)
+        above = np.arange(m)[:,np.newaxis] < kfirst
+        A[:,cols] = np.where(above, A[kfirst,cols], A[:,cols])
+
+    # Differences adjacent to missing data are taken from the previous row
+    # to avoid propagating synthetic data
+    replace = nans.copy()
+    replace[:,1:] |= nans[:,:-1]
+    replace[:,:-1] |= nans[:,1:]
 
-        D2[i,:] = diff1(A[i,:], x)
+    D2 = np.empty_like(A_)
+    for i in range(m):
+        if i != 0:
+            rownans = np.isnan(A[i])
+            if np.any(rownans) and not np.all(rownans):
+                A[i] = erode_nans(A[i], D2[i-1])
 
-        if i != 0:                      # Replace differences with the previous row
-            nans = np.isnan(A_[i,:])    # to avoid propagating synthetic data
-            nans = binary_dilation(nans)
-            D2[i,nans] = D2[i-1,nans]
+        D2[i] = diff1(A[i], x)
+        if i != 0:
+            D2[i,replace[i]] = D2[i-1,replace[i]]
 
-    D2[np.isnan(A_)] = np.nan
+    D2[nans] = np.nan
     return D2
 
 def diff1_inner(V, x):
@@ -163,45 +162,72 @@ def diff2_inner(A, x):
     possible. """
     (m, n) = A.shape
     D2 = np.nan * np.empty((m, n-1))
-    for (i, arow) in enumerate(A):
-        start = -1
-        for j in range(len(arow)-1):
-
-            if start == -1 and ~np.isnan(arow[j]):
-                start = j
+    if n < 3:
+        return D2
+    # Differences involving a NaN are NaN. The final difference is only
+    # retained when the third-last value is valid, as in a left-to-right
+    # scan for runs of valid data.
+    D2[:,:] = (A[:,1:] - A[:,:-1]) / (x[1:] - x[:-1])
+    D2[np.isnan(A[:,-3]),-1] = np.nan
+    return D2
 
-            elif start != -1 and np.isnan(arow[j]):
-                if j - start != 1:
-                    D2[i,start:j-1] = diff1_inner(arow[start:j], x[start:j])
-                start = -1
+def uintegrate(dudz, X, ubase=0.0, out=None):
+    """ Integrate velocity shear from the first non-NaN value to the top.
 
-            elif start != -1 and j == len(arow) - 2:
-                D2[i,start:] = diff1_inner(arow[start:], x[start:])
-    return D2
+    All columns are integrated at once with the trapezoidal rule, and each is
+    referenced so that the velocity at its deepest valid level equals `ubase`,
+    which may be a scalar or a vector with one value per column. NaNs above
+    the deepest valid level are treated as zero shear, values below it are
+    returned as NaN, and columns with no valid shear are entirely NaN.
 
-def uintegrate(dudz, X, ubase=0.0):
-    """ Integrate velocity shear from the first non-NaN value to the top. """
-    U = -np.nan*np.empty_like(dudz)
-    if isinstance(ubase, numbers.Number):
-        ubase = ubase * np.ones(dudz.shape[1], dtype=np.float64)
-
-    for jcol in range(dudz.shape[1]):
-        # find the deepest non-NaN
-        imax = np.max(np.arange(dudz.shape[0])[~np.isnan(dudz[:,jcol])])
-        du = dudz[:imax+1,jcol]
-        du[np.isnan(du)] = 0.0
-        U[:imax+1,jcol] = scint.cumtrapz(du, x=X[:imax+1,jcol],
-                                         initial=0.0)
-        U[:imax+1,jcol] -= U[imax,jcol] - ubase[jcol]
-    return U
+    If `out::ndarray` is provided, the result is written into it and returned.
+    `dudz` is not modified.
+    """
+    (m, n) = dudz.shape
+    if out is None:
+        out = -np.nan*np.empty_like(dudz)
+    elif out.shape != dudz.shape:
+        raise ValueError("output buffer must have shape {0}".format(dudz.shape))
+    ubase = np.broadcast_to(np.asarray(ubase, dtype=np.float64), (n,))
+
+    valid = ~np.isnan(dudz)
+    imax = m - 1 - np.argmax(valid[::-1], axis=0)   # deepest non-NaN
+    below = (np.arange(m)[:,np.newaxis] > imax) | ~np.any(valid, axis=0)
+    du = np.where(valid, dudz, 0.0)
+    du[below] = 0.0
+
+    out[0] = 0.0
+    np.cumsum((X[1:] - X[:-1]) * (du[1:] + du[:-1]) / 2.0, axis=0, out=out[1:])
+    out -= out[imax,np.arange(n)] - ubase
+    out[below] = np.nan
+    return out
 
 def eof_timeseries(data, eofs):
     """ Compute EOF time(space) series from a data matrix and a matrix of
     eigenvalues. """
-    N,M = data.shape
-    F = np.zeros((N,M))
-    for j in range(M):
-        for i in range(M):
-            F[:,j] += eofs[i,j] * data[:,i]
-    return F
-
+    return np.dot(data, eofs)
+
+def truncated_svd(A, k):
+    """ Return the leading `k::int` singular values and vectors of A as
+    (U, sigma, Vh), in order of decreasing singular value. Uses an iterative
+    (ARPACK) solver, so that the cost scales with `k` rather than with the
+    size of A. """
+    if k >= min(A.shape):
+        U, sigma, Vh = np.linalg.svd(A, full_matrices=False)
+        return U[:,:k], sigma[:k], Vh[:k]
+    U, sigma, Vh = svds(A, k=k)
+    order = np.argsort(sigma)[::-1]
+    return U[:,order], sigma[order], Vh[order]
+
+def randomized_svd(A, k, oversample=10, n_iter=4, random_state=None):
+    """ Approximate the leading `k::int` singular values and vectors of A as
+    (U, sigma, Vh) using a randomized range finder with `n_iter::int` power
+    iterations (Halko, Martinsson, and Tropp, 2011). """
+    rng = np.random.RandomState(random_state)
+    l = min(k + oversample, min(A.shape))
+    Q = np.linalg.qr(np.dot(A, rng.standard_normal((A.shape[1], l))))[0]
+    for _ in range(n_iter):
+        Q = np.linalg.qr(np.dot(A.T, Q))[0]
+        Q = np.linalg.qr(np.dot(A, Q))[0]
+    Ub, sigma, Vh = np.linalg.svd(np.dot(Q.T, A), full_matrices=False)
+    return np.dot(Q, Ub[:,:k]), sigma[:k], Vh[:k]
@@ -30,12 +30,27 @@ class BathymetryTests(unittest.TestCase):
                 Cast(np.arange(100), T=np.random.rand(100), S=np.random.rand(100),
                      coords=(-17.45, 80.16)))
         cc.add_bathymetry(self.bathymetry)
-        correctresult = np.array([92.61373822294766, 123.15924954803165,
-                                  150.24992416068667])
+        # nearest positions found exactly on great circle segments; earlier
+        # values were found by bisection to within 1 m
+        correctresult = np.array([92.61167178316909, 123.15458158664151,
+                                  150.24806262844575])
         depths = [c.properties["depth"] for c in cc]
         self.assertTrue(np.allclose(depths, correctresult))
         return
 
+    def test_atxy_many(self):
+        lons = np.array([-17.42, -17.426, np.nan, -17.45, -17.5, -17.41])
+        lats = np.array([80.09, 80.112, 80.1, 80.16, 80.2, 80.0])
+        depths = self.bathymetry.atxy_many(lons, lats)
+        self.assertTrue(np.isnan(depths[2]))
+        # beyond the ends of the line, depth is that of the end vertex
+        self.assertEqual(depths[4], 130.0)
+        self.assertEqual(depths[5], 102.0)
+        self.assertEqual(depths[3], self.bathymetry.atxy(-17.45, 80.16))
+        # on a vertex
+        self.assertAlmostEqual(self.bathymetry.atxy(-17.4437, 80.12305), 140.0)
+        return
+
     def test_project_along_cruise(self):
         cruiseline = karta.Line([(0,0), (4,3), (6,2), (6,5)], crs=LONLAT_WGS84)
         bath = Bathymetry([(0,0), (2,1), (3,3), (5,3), (7,3), (5,4), (7,4.5)],
@@ -52,3 +67,24 @@ class BathymetryTests(unittest.TestCase):
             self.assertAlmostEqual(qa, q, 4)
         return
 
+    def test_project_along_cruise_chunked_cached(self):
+        cruiseline = karta.Line([(0,0), (4,3), (6,2), (6,5)], crs=LONLAT_WGS84)
+        bath = Bathymetry([(0,0), (2,1), (3,3), (5,3), (7,3), (5,4), (7,4.5)],
+                          depth=[100, 120, 130, 135, 115, 127, 119])
+        P, Q = bath.project_along_cruise(cruiseline, chunksize=4)
+        P[:] = 0.0
+        # an equal cruise line reuses the cached projection
+        cruiseline = karta.Line([(0,0), (4,3), (6,2), (6,5)], crs=LONLAT_WGS84)
+        P2, Q2 = bath.project_along_cruise(cruiseline)
+        self.assertEqual(len(bath._projections), 1)
+        self.assertTrue(np.all(Q2 == Q))
+        self.assertAlmostEqual(P2[1], 244562.46558282, 4)
+
+        # a different cruise line is cached under its own digest
+        cruiseline = karta.Line([(0,0), (4,3), (6,2), (6,6)], crs=LONLAT_WGS84)
+        bath.project_along_cruise(cruiseline)
+        self.assertEqual(len(bath._projections), 2)
+        for key in bath._projections:
+            self.assertEqual([len(digest) for (digest, _, _) in key], [20, 20])
+        return
+
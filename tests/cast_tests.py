@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import unittest
 import os
+import shutil
+import tempfile
+import datetime
 import numpy as np
 import narwhal
 from narwhal import gsw
@@ -9,12 +12,33 @@ from narwhal.cast import CastCollection
 from narwhal.bathymetry import Bathymetry
 from narwhal.util import force_monotonic, diff2, uintegrate, diff2_inner
 from narwhal import util
+from narwhal import sharedmem
+from narwhal.cache import DerivationCache
+from karta import Point
+
+try:
+    from karta.crs import crsreg
+except ImportError:
+    import karta as crsreg
+LONLAT_WGS84 = crsreg.LONLAT_WGS84
 
 directory = os.path.dirname(__file__)
 DATADIR = os.path.join(directory, "data")
 if not os.path.exists(DATADIR):
     os.mkdir(DATADIR)
 
+def _scaled_temp(cast):
+    # module-level so that it can be sent to worker processes
+    return Cast(cast["z"], temp=2*cast["temp"], station=cast.p["station"])
+
+def _identity(cast):
+    return cast
+
+def _shared_mappings():
+    """ Return the number of shared memory blocks mapped by this process. """
+    with open("/proc/self/maps") as f:
+        return sum("psm_" in line for line in f)
+
 class CastTests(unittest.TestCase):
 
     def setUp(self):
@@ -101,6 +125,75 @@ class CastTests(unittest.TestCase):
         self.assertTrue(np.allclose(rho, cast["rho"]))
         return
 
+    def test_add_density_cached(self):
+        p = np.arange(10.0)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = DerivationCache(tmpdir)
+            cast = CTDCast(p, 30.0 + 0.25*p, 20.0 - 0.2*p, coords=(-20, 50))
+            cast.add_density(cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+            other = CTDCast(p, 30.0 + 0.25*p, 20.0 - 0.2*p, coords=(-20, 50))
+            other.add_density(cache=DerivationCache(tmpdir))
+            self.assertTrue(np.all(other["rho"] == cast["rho"]))
+            other.add_density(rhokey="rho_2", cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # changed data or coordinates are recomputed
+            other.data["temp"] = other["temp"] + 1.0
+            other.add_density(cache=cache)
+            CTDCast(p, 30.0 + 0.25*p, 20.0 - 0.2*p, coords=(-20, 51))\
+                    .add_density(cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (1, 3))
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_cache_eviction(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = DerivationCache(tmpdir, maxsize=20000)
+            for i in range(5):
+                key = cache.key("test", [np.arange(i, i+1000.0)])
+                cache.put(key, [np.arange(1000.0)])
+            self.assertTrue(cache.size() <= 20000)
+            self.assertEqual(cache.get(key)[0][999], 999.0)
+            first = cache.key("test", [np.arange(0, 1000.0)])
+            self.assertEqual(cache.get(first), None)
+            self.assertEqual([f for f in os.listdir(tmpdir)
+                              if not f.endswith(".npz")], [])
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_cache_scans_only_when_full(self):
+        class CountingCache(DerivationCache):
+            scans = 0
+            def _entries(self):
+                self.scans += 1
+                return DerivationCache._entries(self)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = CountingCache(tmpdir, maxsize=20000)
+            for i in range(2):
+                cache.put(cache.key("test", [np.arange(i, i+10.0)]),
+                          [np.arange(1000.0)])
+            # replacing an entry does not grow the tracked size
+            cache.put(cache.key("test", [np.arange(0, 10.0)]),
+                      [np.arange(1000.0)])
+            self.assertEqual(cache.scans, 1)
+            self.assertEqual(cache._size, cache.size())
+            for i in range(2, 5):
+                cache.put(cache.key("test", [np.arange(i, i+10.0)]),
+                          [np.arange(1000.0)])
+            self.assertTrue(cache.scans > 2)
+            self.assertTrue(cache.size() <= 20000)
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
     def test_add_buoyancy_freq_squared(self):
         # This is a fairly lousy test, merely ensuring that an N^2 field was
         # calculated, and that it's not wildly different than the direct
@@ -216,6 +309,140 @@ class CastCollectionTests(unittest.TestCase):
         self.assertEqual(casts, cc[6:8] + cc[4])
         return
 
+    def test_proptable(self):
+        table = self.cc.proptable
+        self.assertEqual(len(table), 10)
+        self.assertTrue(np.all(table["station"] == np.arange(10)))
+        self.assertTrue(np.all(np.isnan(table["lon"])))
+        return
+
+    def test_subset_from_proptable(self):
+        cc = self.cc
+        table = cc.proptable
+        subcc = cc.subset((table["val"] <= 3) & (table["uniq_val"] > -64))
+        self.assertEqual(subcc, cc[2:8])
+        self.assertEqual(cc.subset(table.isin("station", (3, 5))), cc[3] + cc[5])
+        return
+
+    def test_between_dates(self):
+        p = np.linspace(1, 999, 50)
+        dates = [datetime.datetime(2000+i, 1+i, 1) for i in range(10)]
+        cc = CastCollection([Cast(p, temp=np.ones_like(p), date=d)
+                             for d in dates[::-1]])
+        subcc = cc.between("date", datetime.datetime(2003, 1, 1), "2006-06-01")
+        self.assertEqual([c.p["date"] for c in subcc], dates[5:2:-1])
+        return
+
+    def test_projdist(self):
+        p = np.linspace(1, 999, 50)
+        coords = [(-130.0+0.3*i, 50.0+0.1*i**0.5) for i in range(6)]
+        cc = CastCollection([Cast(p, temp=np.ones_like(p), coords=c)
+                             for c in coords])
+        d = cc.projdist()
+        pts = [Point(c, crs=LONLAT_WGS84) for c in coords]
+        dref = np.cumsum([0.0] + [a.distance(b) for a, b in zip(pts[:-1], pts[1:])])
+        self.assertTrue(np.allclose(d, dref, atol=1e-3))
+
+        # cached result is invalidated when coordinates change
+        cc[2].properties["coordinates"] = (-128.0, 51.0)
+        self.assertNotEqual(cc.projdist()[2], d[2])
+        return
+
+    def test_map_serial(self):
+        stations = self.cc.map(lambda c: c.p["station"])
+        self.assertEqual(stations, list(range(10)))
+        return
+
+    def test_map_thread(self):
+        result = self.cc.map(_scaled_temp, executor="thread", workers=2)
+        self.assertTrue(isinstance(result, CastCollection))
+        self.assertEqual(result["station"], list(range(10)))
+        self.assertTrue(np.all(result[3]["temp"] == 4.0))
+        return
+
+    def test_map_process(self):
+        result = self.cc.map(_scaled_temp, executor="process", workers=2,
+                             chunksize=3)
+        self.assertTrue(isinstance(result, CastCollection))
+        self.assertEqual(result["station"], list(range(10)))
+        self.assertEqual(set(result[7].fields), set(["temp", "z"]))
+        self.assertTrue(np.all(result[7]["temp"] == 4.0))
+        self.assertTrue(np.all(result[7]["z"] == self.cc[7]["z"]))
+        return
+
+    @unittest.skipIf(sharedmem.shared_memory is None,
+                     "requires multiprocessing.shared_memory")
+    def test_map_sharedmem(self):
+        result = self.cc.map(_scaled_temp, executor="process", workers=2,
+                             sharedmem=True)
+        self.assertEqual(result["station"], list(range(10)))
+        self.assertTrue(np.all(result[7]["temp"] == 4.0))
+        return
+
+    @unittest.skipIf(sharedmem.shared_memory is None or
+                     not os.path.exists("/proc/self/maps"),
+                     "requires multiprocessing.shared_memory and procfs")
+    def test_map_sharedmem_reused_executor(self):
+        from concurrent import futures
+        with futures.ProcessPoolExecutor(max_workers=1) as executor:
+            # start the worker before any block exists to be inherited
+            self.assertEqual(executor.submit(_shared_mappings).result(), 0)
+            for _ in range(5):
+                result = self.cc.map(_identity, executor=executor,
+                                     sharedmem=True)
+                self.assertTrue(np.all(result[7]["temp"] == self.cc[7]["temp"]))
+            self.assertEqual(executor.submit(_shared_mappings).result(), 0)
+        return
+
+    @unittest.skipIf(sharedmem.shared_memory is None,
+                     "requires multiprocessing.shared_memory")
+    def test_sharedmem_attach(self):
+        with sharedmem.SharedCollection(self.cc) as shared:
+            cc = sharedmem.attach(shared.descriptor)
+            self.assertEqual(len(cc), 10)
+            self.assertEqual(cc[4].fields, self.cc[4].fields)
+            self.assertEqual(cc[4].p["station"], 4)
+            self.assertTrue(np.all(cc[4]["sal"] == self.cc[4]["sal"]))
+            with self.assertRaises(ValueError):
+                cc[4].data["sal"].values[0] = 0.0
+            del cc
+            sharedmem.detach(shared.descriptor)
+        return
+
+    def test_to_frame(self):
+        self.cc[3].p["cruise"] = "AT01"
+        df = self.cc.to_frame()
+        self.assertEqual(len(df), 5000)
+        self.assertEqual(list(df.columns[:2]), ["cast", "station"])
+        self.assertEqual(df.columns[-3], "z")
+        self.assertEqual(set(df.columns[-3:]), set(self.cc[0].fields))
+        self.assertEqual(df["cruise"].dtype.name, "category")
+        self.assertEqual(df["cruise"].iloc[1500], "AT01")
+        self.assertTrue(np.all(df["station"].values[500:1000] == 1))
+        self.assertTrue(np.all(df["temp"].values == 2.0))
+        return
+
+    def test_frame_roundtrip(self):
+        self.cc[2].data["oxy"] = np.linspace(0, 1, 500)
+        cc = CastCollection.from_frame(self.cc.to_frame())
+        self.assertEqual(len(cc), 10)
+        self.assertEqual(cc[2].zname, "z")
+        self.assertEqual(set(cc[2].fields), set(self.cc[2].fields))
+        self.assertEqual(cc[7].p["val"], 2)
+        self.assertTrue(np.all(cc[2]["oxy"] == self.cc[2]["oxy"]))
+        self.assertTrue(np.all(np.isnan(cc[3]["oxy"])))
+        self.assertTrue(np.all(cc[5]["z"] == self.cc[5]["z"]))
+        return
+
+    def test_from_frame_unsorted(self):
+        df = self.cc.to_frame().iloc[::-1]
+        cc = CastCollection.from_frame(df, zname="z",
+                                       properties=["station", "val"])
+        self.assertEqual(cc["station"], list(range(9, -1, -1)))
+        self.assertTrue(np.all(cc[0]["z"].values == self.cc[9]["z"].values[::-1]))
+        self.assertNotIn("uniq_val", cc[0].p)
+        return
+
     def test_defray(self):
         lengths = np.arange(50, 71)
         casts = []
@@ -237,12 +464,108 @@ class CastCollectionTests(unittest.TestCase):
                  for i in range(3)]
         cc = CastCollection(casts)
         structures, lamb, eofs = cc.eofs("theta")
-        self.assertAlmostEqual(np.mean(np.abs(structures["theta_eof1"])), 0.634719360307)
-        self.assertAlmostEqual(np.mean(np.abs(structures["theta_eof2"])), 0.363733575635)
-        self.assertAlmostEqual(np.mean(np.abs(structures["theta_eof3"])), 0.350665870142)
+        self.assertAlmostEqual(np.mean(np.abs(structures["theta_eof1"])), 0.643940494913)
+        self.assertAlmostEqual(np.mean(np.abs(structures["theta_eof2"])), 0.423752865480)
+        self.assertAlmostEqual(np.mean(np.abs(structures["theta_eof3"])), 0.090111776790)
         self.assertTrue(np.allclose(lamb, [87.27018523, 40.37800904, 2.02016724]))
         return
 
+    def test_eofs_wide(self):
+        # fewer levels than casts
+        pres = np.arange(1, 6)
+        casts = [Cast(pres, zunits="dbar", zname="pres",
+                      theta=np.sin(pres*i*np.pi/300) + 0.1*np.cos(pres*i*i))
+                 for i in range(8)]
+        cc = CastCollection(casts)
+        for method in ("full", "truncated", "randomized", "incremental"):
+            structures, lamb, eofs = cc.eofs("theta", method=method,
+                                             random_state=42)
+            self.assertEqual(eofs.shape, (8, 5))
+            self.assertEqual(len(lamb), 5)
+            self.assertTrue("theta_eof5" in structures.fields)
+            self.assertFalse("theta_eof6" in structures.fields)
+        return
+
+    def test_eofs_full_truncated_agree(self):
+        pres = np.arange(1, 300)
+        casts = [Cast(pres, zunits="dbar", zname="pres",
+                      theta=np.sin(pres*i*np.pi/300) + 0.1*np.cos(pres*i*i))
+                 for i in range(8)]
+        cc = CastCollection(casts)
+        structures, lamb, eofs = cc.eofs("theta", method="full")
+        structures_, lamb_, eofs_ = cc.eofs("theta", n_eofs=3,
+                                            method="truncated")
+        self.assertEqual(eofs.shape, (8, 8))
+        self.assertTrue(np.allclose(lamb[:3], lamb_))
+        for i in range(3):
+            sign = np.sign(np.dot(eofs[:,i], eofs_[:,i]))
+            self.assertTrue(np.allclose(eofs[:,i], sign*eofs_[:,i]))
+            k = "theta_eof%d" % (i+1)
+            self.assertTrue(np.allclose(structures[k], sign*structures_[k]))
+        return
+
+    def test_eofs_truncated(self):
+        pres = np.arange(1, 300)
+        casts = [Cast(pres, zunits="dbar", zname="pres",
+                      theta=np.sin(pres*i*np.pi/300) + 0.1*np.cos(pres*i*i))
+                 for i in range(8)]
+        cc = CastCollection(casts)
+        arr = cc.asarray("theta")
+        arr -= arr.mean()
+        U, sigma, _ = np.linalg.svd(arr, full_matrices=False)
+        for method in ("truncated", "randomized"):
+            structures, lamb, eofs = cc.eofs("theta", n_eofs=3, method=method,
+                                             random_state=42)
+            self.assertEqual(eofs.shape, (8, 3))
+            self.assertTrue(np.allclose(lamb, sigma[:3]**2/7))
+            for i in range(3):
+                self.assertTrue(np.allclose(np.abs(structures["theta_eof%d" % (i+1)]),
+                                            np.abs(U[:,i]*sigma[i])))
+        return
+
+    def test_eofs_incremental(self):
+        pres = np.arange(1, 300)
+        thetas = [np.sin(pres*i*np.pi/300) + 0.1*np.cos(pres*i*i)
+                  for i in range(8)]
+        thetas[3][10:12] = np.nan
+        casts = [Cast(pres, zunits=narwhal.units.decibar, zname="pres",
+                      theta=theta) for theta in thetas]
+        cc = CastCollection(casts)
+        structures, lamb, eofs = cc.eofs("theta", n_eofs=3, method="truncated")
+        structures_, lamb_, eofs_ = cc.eofs("theta", n_eofs=3,
+                                            method="incremental", batchsize=3)
+        self.assertEqual(len(structures_), 297)
+        self.assertTrue(np.allclose(lamb, lamb_))
+        self.assertTrue(np.allclose(np.abs(eofs), np.abs(eofs_)))
+        for i in range(3):
+            k = "theta_eof%d" % (i+1)
+            self.assertTrue(np.allclose(np.abs(structures[k]), np.abs(structures_[k])))
+
+        # stream from files
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fnms = []
+            for i, cast in enumerate(casts):
+                fnms.append(os.path.join(tmpdir, "cast%d.nwz" % i))
+                cast.save(fnms[-1])
+            _, lamb_, _ = narwhal.eofs_incremental(fnms, "theta", n_eofs=3)
+            self.assertTrue(np.allclose(lamb, lamb_))
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_eofs_gridding(self):
+        casts = [Cast(np.arange(1, 300), theta=np.ones(299)),
+                 Cast(np.arange(1, 200), theta=np.ones(199))]
+        self.assertRaises(ValueError, CastCollection(casts).eofs, "theta")
+
+        casts = [Cast(np.arange(1, 300), theta=np.ones(299)),
+                 Cast(np.arange(2, 301), theta=np.ones(299))]
+        for method in ("full", "incremental"):
+            self.assertRaises(ValueError, CastCollection(casts).eofs, "theta",
+                              method=method)
+        return
+
 class MiscTests(unittest.TestCase):
 
     def test_force_monotonic(self):
@@ -272,6 +595,17 @@ class MiscTests(unittest.TestCase):
         self.assertTrue(np.max(abs(ans[~np.isnan(D)] - D[~np.isnan(D)])) < 0.15)
         return
 
+    def test_diff2_runs(self):
+        x = np.array([0.0, 1.0, 3.0, 4.0, 6.0, 7.0])
+        A = np.array([[1.0, np.nan, 2.0, 4.0, 5.0, np.nan],
+                      [np.nan, 3.0, np.nan, 1.0, 2.0, 4.0]])
+        D = diff2(A, x)
+        ans = np.array([[np.nan, np.nan, 2.0, 1.0, 0.5, np.nan],
+                        [np.nan, np.nan, np.nan, 0.5, 1.0, 2.0]])
+        self.assertTrue(np.array_equal(np.isnan(D), np.isnan(ans)))
+        self.assertTrue(np.allclose(D[~np.isnan(D)], ans[~np.isnan(ans)]))
+        return
+
     def test_diff2_inner(self):
         x = np.atleast_2d(np.linspace(-1, 1, 100))
         A = x**2 - (x + x.T)**3
@@ -315,6 +649,22 @@ class MiscTests(unittest.TestCase):
         self.assertTrue(np.max(abs(ans - I)) < 0.0005)
         return
 
+    def test_uintegrate_columns(self):
+        z = np.tile(np.linspace(0, 100, 11)[:,np.newaxis], (1, 3))
+        dudz = np.ones_like(z)
+        dudz[8:,1] = np.nan
+        dudz[4,2] = np.nan
+        dudz_ = dudz.copy()
+        out = np.empty_like(dudz)
+        U = uintegrate(dudz, z, ubase=np.array([0.0, 1.0, 2.0]), out=out)
+        self.assertTrue(U is out)
+        self.assertTrue(np.array_equal(np.isnan(dudz), np.isnan(dudz_)))
+        self.assertTrue(np.allclose(U[:,0], z[:,0] - 100))
+        self.assertTrue(np.allclose(U[:8,1], z[:8,1] - 70 + 1))
+        self.assertTrue(np.all(np.isnan(U[8:,1])))
+        self.assertEqual(U[-1,2], 2.0)
+        return
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -1,11 +1,19 @@
 import unittest
 import os
 import sys
+import json
+import gzip
+import shutil
+import warnings
+import tempfile
 import datetime
 import numpy as np
 import narwhal
 from narwhal.cast import Cast, CTDCast, XBTCast, LADCP
 from narwhal.cast import CastCollection
+from narwhal.lazy import LazyCastCollection
+from narwhal import fileio
+from narwhal import storage
 
 from io import BytesIO
 if sys.version_info[0] < 3:
@@ -13,9 +21,36 @@ if sys.version_info[0] < 3:
 else:
     from io import StringIO
 
+from scipy.io import netcdf_file
+
 directory = os.path.dirname(__file__)
 DATADIR = os.path.join(directory, "data")
 
+def write_woce_netcdf(fnm, p, temp, sal, station):
+    """ Write a minimal WOCE-style CTD NetCDF file. """
+    nc = netcdf_file(fnm, "w")
+    try:
+        nc.EXPOCODE = "316N145_9"
+        nc.STATION_NUMBER = str(station)
+        nc.createDimension("pressure", len(p))
+        nc.createDimension("time", 1)
+        for name, values in (("pressure", p), ("temperature", temp),
+                             ("salinity", sal)):
+            var = nc.createVariable(name, "f4", ("pressure",))
+            var[:] = values
+            var._FillValue = -999.0
+        qc = nc.createVariable("salinity_QC", "i2", ("pressure",))
+        qc[:] = np.where(np.arange(len(p)) % 10 == 0, 4, 2)
+        for name, value, dtype in (("longitude", -52.5, "f4"),
+                                   ("latitude", 48.25, "f4"),
+                                   ("woce_date", 19930818, "i4"),
+                                   ("woce_time", 1442, "i2")):
+            var = nc.createVariable(name, dtype, ("time",))
+            var[:] = value
+    finally:
+        nc.close()
+    return
+
 class IOTests(unittest.TestCase):
 
     def setUp(self):
@@ -96,6 +131,21 @@ class IOTests(unittest.TestCase):
             f.close()
         return
 
+    def test_save_collection_layout(self):
+        # streamed output matches serializing the whole collection at once
+        d = dict(type="castcollection",
+                 casts=[fileio.castasdict(c) for c in self.collection])
+        f = StringIO()
+        fileio.writecastcollection(f, self.collection, binary=False)
+        self.assertEqual(f.getvalue(), json.dumps(d, indent=2))
+
+        f = BytesIO()
+        self.collection.save(f, compact=True)
+        s = f.getvalue().decode("utf-8")
+        self.assertFalse("\n" in s)
+        self.assertEqual(json.loads(s), json.loads(json.dumps(d)))
+        return
+
     def test_save_zprimarykey(self):
         cast = Cast(np.arange(len(self.p)), temp=self.temp, sal=self.sal,
                     primarykey="z", properties={})
@@ -134,6 +184,473 @@ class IOTests(unittest.TestCase):
         self.assertEqual(coll, self.collection)
         return
 
+    def test_binary_roundtrip(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fnm = os.path.join(tmpdir, "coll.nwb")
+            self.collection.save(fnm)
+            self.assertTrue(fileio.isbinary(fnm))
+            coll = narwhal.read(fnm)
+            self.assertEqual(coll, self.collection)
+            self.assertEqual(coll[1].p["date"], self.xbt.p["date"])
+            self.assertFalse(coll[0].data["temp"].values.flags.writeable)
+
+            fnm = os.path.join(tmpdir, "cast.nwb")
+            self.cast.save(fnm)
+            cast = narwhal.read(fnm)
+            self.assertTrue(isinstance(cast, Cast))
+            self.assertEqual(cast, self.cast)
+
+            lazy = LazyCastCollection(tmpdir)
+            self.assertEqual(len(lazy), 4)
+            lazy.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_storage_policies(self):
+        p = np.arange(0.0, 500.0, 2.0)
+        sal = np.linspace(33.0, 35.0, len(p)) + 1e-5
+        sal[10] = np.nan
+        cast = CTDCast(p, sal, np.linspace(2.0, 10.0, len(p)), coords=(1, 2),
+                       station=1)
+        policies = {"temp": storage.Float32(), "sal": storage.Quantize(0.001),
+                    "pres": storage.RegularGrid()}
+        expected = CTDCast(p, sal, np.linspace(2.0, 10.0, len(p)),
+                           coords=(1, 2), station=1)
+        expected.apply_storage(policies)
+        self.assertEqual(expected["temp"].dtype, np.float32)
+        self.assertTrue(np.nanmax(np.abs(expected["sal"] - sal)) <= 0.0005)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for ext in (".nwz", ".nwb", ".nwd", ".nwx"):
+                fnm = os.path.join(tmpdir, "cast" + ext)
+                cast.save(fnm, storage=policies)
+                result = narwhal.read(fnm)
+                if isinstance(result, CastCollection):
+                    result = result[0]
+                self.assertEqual(result["temp"].dtype, np.float32)
+                for key in ("pres", "sal", "temp"):
+                    np.testing.assert_array_equal(result[key].values,
+                                                  expected[key].values)
+                self.assertEqual(result.p, cast.p)
+
+            # float32 fields in memory are written as float32
+            fnm = os.path.join(tmpdir, "cast32.nwz")
+            result.save(fnm)
+            self.assertEqual(narwhal.read(fnm)["temp"].dtype, np.float32)
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_storage_float32_roundtrip(self):
+        temp = np.linspace(2.0, 10.0, 50).astype(np.float32)
+        temp[5] = np.nan
+        cast = Cast(np.arange(50.0), temp=temp, coords=(1, 2))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for ext in (".nwl", ".nwz", ".nwb", ".nwd", ".nwx"):
+                fnm = os.path.join(tmpdir, "cast" + ext)
+                cast.save(fnm, binary=(ext != ".nwl"))
+                result = narwhal.read(fnm)
+                if isinstance(result, CastCollection):
+                    result = result[0]
+                self.assertEqual(result["temp"].dtype, np.float32)
+                np.testing.assert_array_equal(result["temp"].values, temp)
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_storage_quantize_overflow(self):
+        policy = storage.Quantize(1e-6)
+        self.assertEqual(policy.encode([1e6])[1].dtype, np.int64)
+        self.assertRaises(ValueError, policy.encode, [1e20])
+        self.assertRaises(ValueError, policy.encode, [np.inf])
+        return
+
+    def test_storage_grid_irregular(self):
+        z = np.array([0.0, 1.0, 3.0, 7.0])
+        policy = storage.RegularGrid()
+        self.assertEqual(policy.encode(z), None)
+        self.assertTrue(np.all(policy.apply(z) == z))
+        params, _ = policy.encode(np.linspace(0, 1, 11))
+        self.assertEqual(params["count"], 11)
+        d = fileio.castasdict(Cast(z, temp=z**2), {"z": policy})
+        self.assertEqual(d["vectors"]["z"], z.tolist())
+        return
+
+    def test_geojson(self):
+        buf = BytesIO()
+        fileio.writegeojson(buf, self.collection, properties=["date", "id"],
+                            chunksize=2)
+        d = json.loads(buf.getvalue().decode("utf-8"))
+        self.assertEqual(d["type"], "FeatureCollection")
+        self.assertEqual(len(d["features"]), len(self.collection))
+        feature = d["features"][1]
+        self.assertEqual(feature["geometry"], None)
+        self.assertEqual(feature["properties"]["id"], 1)
+        self.assertEqual(feature["properties"]["date"],
+                         self.xbt.p["date"].isoformat())
+        cast = self.collection[1]
+        self.assertEqual(feature["properties"]["max_depth"],
+                         cast[cast.zname].max())
+        self.assertEqual(feature["properties"]["nvalid"], len(cast))
+
+        cc = CastCollection([Cast(self.p, temp=self.temp, coords=(-60.5, 42.0))])
+        d = json.loads(fileio.castcollection_as_geojson(cc))
+        self.assertEqual(d["features"][0]["geometry"]["coordinates"], [-60.5, 42.0])
+        s = fileio.castcollection_as_geojson(CastCollection([]))
+        self.assertEqual(json.loads(s)["features"], [])
+        return
+
+    def test_iterread(self):
+        for ext in (".nwl", ".nwz"):
+            fnm = os.path.join(DATADIR, "reference_coll_test" + ext)
+            casts = list(narwhal.iterread(fnm))
+            self.assertEqual(CastCollection(casts), self.collection)
+            fnm = os.path.join(DATADIR, "reference_cast_test" + ext)
+            self.assertEqual(list(narwhal.iterread(fnm)), [self.cast])
+        return
+
+    def test_append_lines(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fnm = os.path.join(tmpdir, "coll.nwd")
+            self.collection.append_to(fnm)
+            self.cast.append_to(fnm)
+            coll = narwhal.read(fnm)
+            self.assertEqual(coll, self.collection + self.cast)
+            self.assertEqual(list(narwhal.iterread(fnm)), list(coll))
+
+            # an interrupted append leaves a partial line, which is ignored
+            with open(fnm, "ab") as f:
+                f.write(b'{"type": "cast", "scal')
+            self.assertEqual(len(narwhal.read(fnm)), 4)
+
+            # and is removed by the next append
+            self.ctd.append_to(fnm)
+            coll = narwhal.read(fnm)
+            self.assertEqual(coll, self.collection + self.cast + self.ctd)
+            self.assertEqual(list(narwhal.iterread(fnm)), list(coll))
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_read_lines_parallel(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fnm = os.path.join(tmpdir, "coll.nwd")
+            coll = CastCollection([self.ctd, self.xbt, self.cast]*5)
+            coll.save(fnm)
+            self.assertEqual(narwhal.read(fnm, workers=2), coll)
+            with open(fnm, "rb") as f:
+                n = sum(len(list(fileio.itercastlines(f, a, b)))
+                        for (a, b) in fileio.linesplits(fnm, 7))
+            self.assertEqual(n, 15)
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_blocked_random_access(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fnm = os.path.join(tmpdir, "coll.nwx")
+            casts = []
+            for i in range(12):
+                n = 40 + i
+                casts.append(Cast(self.p[:n], temp=self.temp[:n],
+                                  sal=self.sal[:n], station=i))
+            coll = CastCollection(casts)
+            with open(fnm, "wb") as f:
+                fileio.writeblocked(f, coll, blocksize=8192)
+            self.assertTrue(fileio.isblocked(fnm))
+            self.assertFalse(fileio.isblocked(os.path.join(DATADIR, "reference_coll_test.nwz")))
+
+            reader = fileio.BlockedReader(fnm)
+            self.assertTrue(len(reader._blocks) > 1)
+            self.assertEqual(reader.properties(7)["station"], 7)
+            reader.close()
+
+            self.assertEqual(narwhal.read(fnm), coll)
+            self.assertEqual(narwhal.read(fnm, index=9), coll[9])
+            self.assertEqual(narwhal.read(fnm, index=[3, -1]),
+                             CastCollection(coll[3], coll[11]))
+            sub = narwhal.read(fnm, where=lambda p: p["station"] % 5 == 0)
+            self.assertEqual(sub["station"], [0, 5, 10])
+            self.assertEqual(list(narwhal.iterread(fnm)), list(coll))
+
+            # the file is also a valid multi-member gzip stream
+            with gzip.open(fnm, "rb") as f:
+                f.read()
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_read_selection(self):
+        fnm = os.path.join(DATADIR, "reference_coll_test.nwz")
+        self.assertEqual(narwhal.read(fnm, index=1), self.xbt)
+        self.assertEqual(len(narwhal.read(fnm, where=lambda p: "date" in p)), 3)
+        return
+
+    def test_read_opens_file_once(self):
+        builtins = sys.modules["builtins" if sys.version_info[0] >= 3
+                               else "__builtin__"]
+        builtin_open = builtins.open
+        opened = []
+        def counting_open(*args, **kwargs):
+            opened.append(args[0])
+            return builtin_open(*args, **kwargs)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cc = CastCollection([Cast(self.p, temp=self.temp, sal=self.sal,
+                                      coords=(-52.0, 48.0), station=i)
+                                 for i in range(3)])
+            fnms = [os.path.join(tmpdir, "coll.nwb"),
+                    os.path.join(tmpdir, "coll.nc"),
+                    os.path.join(tmpdir, "woce.nc")]
+            cc.save(fnms[0])
+            cc.to_netcdf(fnms[1])
+            write_woce_netcdf(fnms[2], self.p, self.temp, self.sal, 4)
+            for fnm in fnms:
+                del opened[:]
+                builtins.open = counting_open
+                try:
+                    result = narwhal.read(fnm)
+                finally:
+                    builtins.open = builtin_open
+                self.assertEqual(opened, [fnm])
+                if fnm != fnms[2]:
+                    self.assertTrue(np.all(result[2]["temp"] == self.temp))
+                else:
+                    self.assertEqual(result.p["station"], "4")
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_sniff(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            expected = {".nwl": "json", ".nwz": "gzip", ".nwb": "nwb",
+                        ".nwd": "ndjson", ".nwx": "nwx"}
+            for ext, fmt in expected.items():
+                fnm = os.path.join(tmpdir, "coll" + ext)
+                self.collection.save(fnm, binary=(ext != ".nwl"))
+                with open(fnm, "rb") as f:
+                    self.assertEqual(fileio.sniff(f, fnm), fmt)
+                    self.assertEqual(f.tell(), 0)
+                self.assertEqual(narwhal.read(fnm), self.collection)
+
+            # NetCDF4 (HDF5) files are identified, but not read
+            fnm = os.path.join(tmpdir, "coll.nc")
+            with open(fnm, "wb") as f:
+                f.write(b"\x89HDF\r\n\x1a\n" + b"\x00" * 64)
+            with open(fnm, "rb") as f:
+                self.assertEqual(fileio.sniff(f, fnm), "hdf5")
+            self.assertRaises(IOError, narwhal.read, fnm)
+            self.assertRaises(IOError, LazyCastCollection, fnm)
+
+            # newline-delimited content is recognized without the extension
+            fnm = os.path.join(tmpdir, "coll.txt")
+            shutil.copy(os.path.join(tmpdir, "coll.nwd"), fnm)
+            self.assertEqual(narwhal.read(fnm), self.collection)
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_json_decoder(self):
+        calls = []
+        def decoder(s):
+            calls.append(len(s))
+            return json.loads(s.decode("utf-8"))
+        default = fileio.JSON_DECODER
+        fileio.JSON_DECODER = decoder
+        try:
+            coll = narwhal.read(os.path.join(DATADIR, "reference_coll_test.nwz"))
+        finally:
+            fileio.JSON_DECODER = default
+        self.assertEqual(coll, self.collection)
+        self.assertEqual(len(calls), 1)
+        return
+
+    def test_read_many(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for i in range(6):
+                cast = Cast(self.p, temp=self.temp, sal=self.sal, station=5-i)
+                cast.save(os.path.join(tmpdir, "cast{0}.nwz".format(i)))
+            with open(os.path.join(tmpdir, "corrupt.nwz"), "wb") as f:
+                f.write(b"not a cast")
+
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter("always")
+                coll = narwhal.read_many(tmpdir, workers=2)
+            self.assertEqual(len(w), 1)
+            self.assertTrue("corrupt.nwz" in str(w[0].message))
+            self.assertEqual(coll["station"], [5, 4, 3, 2, 1, 0])
+
+            pattern = os.path.join(tmpdir, "cast*.nwz")
+            coll = narwhal.read_many(pattern, workers=1, sortby="station")
+            self.assertEqual(coll["station"], list(range(6)))
+
+            with self.assertRaises(Exception):
+                narwhal.read_many(tmpdir, errors="raise")
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_read_woce_netcdf(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            temp = self.temp.copy()
+            temp[3] = -999.0
+            for i in range(3):
+                write_woce_netcdf(os.path.join(tmpdir, "ctd{0}.nc".format(i)),
+                                  self.p, temp, self.sal, 10+i)
+            cast = narwhal.read(os.path.join(tmpdir, "ctd0.nc"))
+            self.assertEqual(cast.zname, "pres")
+            self.assertEqual(cast.p["date"], datetime.datetime(1993, 8, 18, 14, 42))
+            self.assertEqual(cast.p["expocode"], "316N145_9")
+            self.assertAlmostEqual(cast.coords[1], 48.25)
+            self.assertTrue(np.isnan(cast["temp"][3]))
+            self.assertEqual(np.sum(np.isnan(cast["sal"])), len(self.p) // 10)
+            self.assertTrue(np.allclose(cast["sal"][1:10], self.sal[1:10]))
+
+            coll = narwhal.read_woce_many(tmpdir, workers=2)
+            self.assertEqual(coll["station"], ["10", "11", "12"])
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_netcdf_ragged(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fnm = os.path.join(tmpdir, "coll.nc")
+            casts = []
+            for i in range(5):
+                n = 50 + 10*i
+                casts.append(CTDCast(self.p[:n], self.sal[:n], self.temp[:n],
+                                     coords=(-52.0+i, 48.0), station=i,
+                                     cruise="KN200",
+                                     date=datetime.datetime(2010, 5, 1+i, 6)))
+            coll = CastCollection(casts)
+            coll.to_netcdf(fnm)
+
+            nc = netcdf_file(fnm, "r", mmap=False)
+            self.assertEqual(nc.featureType, b"profile")
+            self.assertEqual(list(nc.variables["rowSize"].data), [50, 60, 70, 80, 90])
+            nc.close()
+
+            result = narwhal.read(fnm)
+            self.assertEqual(len(result), 5)
+            self.assertEqual(result[3].zname, "pres")
+            self.assertEqual(result[3].zunits, narwhal.units.decibar)
+            self.assertTrue(np.all(result[3]["temp"] == casts[3]["temp"]))
+            self.assertEqual(result[3].coords, (-49.0, 48.0))
+            self.assertEqual(result[3].p["date"], casts[3].p["date"])
+            self.assertEqual(result[3].p["cruise"], "KN200")
+            self.assertEqual(result["station"], list(range(5)))
+
+            cast = narwhal.read_netcdf(fnm, index=2)
+            self.assertEqual(len(cast["sal"]), 70)
+            lazy = LazyCastCollection(fnm)
+            self.assertEqual(lazy["station"], list(range(5)))
+            self.assertTrue(np.all(lazy[4]["sal"] == casts[4]["sal"]))
+            lazy.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_netcdf_ragged_reserved_names(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # a "time" field alongside a datetime "date" property
+            fnm = os.path.join(tmpdir, "time.nc")
+            cast = Cast(self.p[:10], temp=self.temp[:10],
+                        time=np.arange(10.0), coords=(-52.0, 48.0),
+                        date=datetime.datetime(2010, 5, 1, 6))
+            CastCollection([cast]).to_netcdf(fnm)
+            result = narwhal.read(fnm)[0]
+            self.assertTrue(np.all(result["time"] == np.arange(10.0)))
+            self.assertEqual(result.p["date"], cast.p["date"])
+            self.assertEqual(result.coords, (-52.0, 48.0))
+
+            # a "rowSize" property
+            fnm = os.path.join(tmpdir, "rowsize.nc")
+            cast = Cast(self.p[:10], temp=self.temp[:10], rowSize=3.0)
+            CastCollection([cast]).to_netcdf(fnm)
+            result = narwhal.read(fnm)[0]
+            self.assertEqual(len(result), 10)
+            self.assertEqual(result.p["rowSize"], 3.0)
+            self.assertTrue(np.all(result["temp"] == cast["temp"]))
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
+    def test_scancasts(self):
+        f = BytesIO()
+        self.collection.save(f)
+        f.seek(0)
+        offsets = []
+        for (offset, nbytes, d) in fileio.scancasts(f, chunksize=64):
+            self.assertEqual(d["type"], "cast")
+            offsets.append((offset, nbytes))
+        self.assertEqual(len(offsets), 3)
+        for (offset, nbytes), cast in zip(offsets, self.collection):
+            f.seek(offset)
+            d = json.loads(f.read(nbytes).decode("utf-8"))
+            self.assertEqual(fileio.dictascast(d, Cast), cast)
+        return
+
+    def test_lazy_collection(self):
+        for ext in (".nwl", ".nwz"):
+            fnm = os.path.join(DATADIR, "reference_coll_test" + ext)
+            with LazyCastCollection(fnm, cachesize=2) as coll:
+                self.assertEqual(len(coll), 3)
+                self.assertEqual(coll["date"], [c.p["date"] for c in self.collection])
+                self.assertEqual(coll, self.collection)
+                self.assertTrue(len(coll._cache) <= 2)
+                sub = coll[1:]
+                self.assertTrue(isinstance(sub, LazyCastCollection))
+                self.assertEqual(sub[1], self.collection[2])
+        return
+
+    def test_lazy_collection_properties(self):
+        fnm = os.path.join(DATADIR, "reference_coll_test.nwz")
+        coll = LazyCastCollection(fnm, cachesize=1)
+        coll[0].properties["station"] = 7
+        coll[1]     # evicts the first cast
+        self.assertEqual(coll[0].properties["station"], 7)
+        sub = coll.castswhere("station", 7)
+        self.assertTrue(isinstance(sub, LazyCastCollection))
+        self.assertEqual(len(sub), 1)
+
+        # the property table reflects changes made through loaded casts
+        self.assertEqual(list(coll.proptable["station"]).count(7), 1)
+        sub[0].properties["station"] = 8
+        self.assertEqual(list(coll.proptable["station"]).count(8), 1)
+        coll.close()
+        return
+
+    def test_lazy_collection_coordinates(self):
+        casts = [Cast(self.p, temp=self.temp, coords=(-60.0 + i, 42.0))
+                 for i in range(4)]
+        cc = CastCollection(casts)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fnm = os.path.join(tmpdir, "coll.nwd")
+            cc.save(fnm)
+            with LazyCastCollection(fnm) as lazy:
+                self.assertEqual(len(lazy.coords), 4)
+                self.assertTrue(np.allclose(lazy.projdist(), cc.projdist()))
+                self.assertTrue(np.allclose(lazy.distance_matrix(),
+                                            cc.distance_matrix()))
+                self.assertEqual(len(lazy._cache), 0)
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+
 #    def test_load_zprimarykey(self):
 #        castl = narwhal.read(os.path.join(DATADIR, "reference_ctdz_test.nwl"))
 #        cast = CTDCast(self.p, temp=self.temp, sal=self.sal,
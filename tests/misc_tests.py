@@ -1,6 +1,6 @@
 import unittest
 import numpy as np
-from narwhal import util, gsw
+from narwhal import util, gsw, geodesy
 
 class GSWTests(unittest.TestCase):
 
@@ -12,6 +12,39 @@ class GSWTests(unittest.TestCase):
         pt = gsw.pt_from_t(s, t, p, p0)
         return
 
+class GeodesyTests(unittest.TestCase):
+
+    def test_vincenty(self):
+        # Flinders Peak to Buninyong (Vincenty, 1975)
+        d = geodesy.vincenty(144.42486789, -37.95103342, 143.92649553, -37.65282114)
+        self.assertAlmostEqual(d, 54972.271, 3)
+        return
+
+    def test_haversine(self):
+        d = geodesy.haversine(0.0, 0.0, [0.0, 90.0], [90.0, 0.0])
+        self.assertTrue(np.allclose(d, 0.5*np.pi*geodesy.EARTH_RADIUS))
+        return
+
+    def test_cumulative_distance(self):
+        lons = np.array([-130.0, -129.5, -129.0, -128.0])
+        lats = np.array([50.0, 50.2, 50.1, 50.6])
+        cumulative = geodesy.cumulative_distance(lons, lats)
+        self.assertEqual(cumulative[0], 0.0)
+        self.assertAlmostEqual(cumulative[-1],
+                sum(geodesy.vincenty(lons[i], lats[i], lons[i+1], lats[i+1])
+                    for i in range(3)), 6)
+        return
+
+    def test_distance_matrix_chunks(self):
+        lons = np.linspace(-40, 40, 25)
+        lats = np.linspace(-60, 70, 25)
+        D = geodesy.distance_matrix(lons, lats, chunksize=7)
+        self.assertTrue(np.allclose(D, D.T))
+        self.assertTrue(np.all(np.diag(D) == 0.0))
+        self.assertAlmostEqual(D[3,17], geodesy.vincenty(lons[3], lats[3],
+                                                         lons[17], lats[17]), 6)
+        return
+
 class DerivativeTests(unittest.TestCase):
 
     def test_diffmat_first(self):